@@ -0,0 +1,4 @@
+# coding=utf-8
+"""
+crawler_html2pdf、crawler_heart 以及 PythonCrawler 下的示例爬虫共用的组件
+"""
@@ -0,0 +1,240 @@
+# coding=utf-8
+"""
+抓取边界（frontier）：URL 规范化 + 布隆过滤器去重 + 按优先级出队的待抓取队列。
+布隆过滤器的大小在创建时固定，待抓取队列超过 memory_items 时排序后写入磁盘，
+所以 URL 数量增长到千万级时内存占用基本不变
+"""
+import hashlib
+import heapq
+import math
+import os
+import pickle
+import re
+import shutil
+import struct
+import tempfile
+
+try:
+    from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit   # py3
+except ImportError:
+    from urllib import urlencode
+    from urlparse import parse_qsl, urlsplit, urlunsplit
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+_ESCAPE = re.compile(r"%[0-9a-fA-F]{2}")
+
+
+def _remove_dot_segments(path):
+    segments = []
+    for segment in path.split("/"):
+        if segment == "..":
+            if len(segments) > 1:
+                segments.pop()
+        elif segment != ".":
+            segments.append(segment)
+    if path.endswith(("/.", "/..")):
+        segments.append("")
+    return "/".join(segments) or "/"
+
+
+def normalize_url(url):
+    """
+    规范化 URL，写法不同但指向同一页面的 URL 得到相同的结果，端口不是数字等无效的 URL 抛出 ValueError：
+    协议和主机名小写，去掉默认端口和 #片段，解析 . 和 ..，百分号编码大写，查询参数按参数名排序
+    （稳定排序，同名参数保持原来的先后顺序，?a=2&a=1 和 ?a=1&a=2 不是同一个页面）
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if ":" in host:
+        host = "[%s]" % host    # IPv6 地址，hostname 去掉了方括号
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = "%s:%d" % (host, parts.port)
+    if parts.username:
+        userinfo = parts.username + (":" + parts.password if parts.password else "")
+        host = userinfo + "@" + host
+    path = _ESCAPE.sub(lambda m: m.group(0).upper(), _remove_dot_segments(parts.path or "/"))
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True), key=lambda item: item[0]))
+    return urlunsplit((scheme, host, path, query, ""))
+
+
+class BloomFilter(object):
+    """
+    固定大小的布隆过滤器：不会漏判，误判率约为 error_rate（插入数不超过 capacity 时）。
+    一千万个 URL、千分之一误判率大约占用 18 MB
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.bits / float(capacity) * math.log(2))))
+        self.count = 0
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, item):
+        # 双重哈希：一次 sha1 得到两个 64 位整数，组合出 hashes 个位置
+        digest = hashlib.sha1(item.encode("utf-8")).digest()
+        h1, h2 = struct.unpack_from(">QQ", digest)
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.bits
+
+    def __contains__(self, item):
+        array = self._array
+        return all(array[p >> 3] & (1 << (p & 7)) for p in self._positions(item))
+
+    def add(self, item):
+        """
+        :return: item 之前不在过滤器中时返回 True
+        """
+        array = self._array
+        added = False
+        for p in self._positions(item):
+            mask = 1 << (p & 7)
+            if not array[p >> 3] & mask:
+                array[p >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    @property
+    def nbytes(self):
+        return len(self._array)
+
+
+class _Run(object):
+    """
+    磁盘上一段已排序的队列，逐条读取，内存中只保留当前条目
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.head = None
+        self.advance()
+
+    def advance(self):
+        try:
+            self.head = pickle.load(self.file)
+        except EOFError:
+            self.head = None
+            self.close()
+        return self.head
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            os.remove(self.path)
+
+
+class Frontier(object):
+    """
+    用法：
+        frontier = Frontier()
+        frontier.add(url)                   # 重复的 URL 返回 False
+        frontier.add(url, priority=-1)      # 数值越小越先出队，相同优先级先进先出
+        while frontier:
+            url = frontier.pop()            # 按规范化后的 URL 去重，出队的是原始 URL
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.0001, memory_items=100000, spill_dir=None,
+                 normalize=normalize_url):
+        """
+        :param capacity: 预计的 URL 总数，决定布隆过滤器的大小；超出后误判率上升，会漏抓部分页面
+        :param error_rate: 布隆过滤器的误判率，误判的 URL 会被当成已见过而跳过
+        :param memory_items: 内存中最多保留的待抓取 URL 数，超过后排序写入磁盘
+        :param spill_dir: 溢出文件的父目录，默认为系统临时目录
+        :param normalize: URL 规范化函数，为 None 时不规范化
+        """
+        self.seen = BloomFilter(capacity, error_rate)
+        self.memory_items = memory_items
+        self.spill_dir = spill_dir
+        self.normalize = normalize
+        self.spilled = 0            # 当前在磁盘上的 URL 数
+        self.spilled_total = 0
+        self.duplicates = 0
+        self._heap = []
+        self._runs = []             # (当前条目, 序号, _Run) 的堆
+        self._run_dir = None
+        self._counter = 0
+
+    def __len__(self):
+        return len(self._heap) + self.spilled
+
+    def __bool__(self):
+        return len(self) > 0
+
+    __nonzero__ = __bool__
+
+    def __contains__(self, url):
+        return (self.normalize(url) if self.normalize else url) in self.seen
+
+    def add(self, url, priority=0):
+        """
+        :return: url 是新的 URL 并已加入队列时返回 True
+        """
+        # 规范化只用于去重，队列里保存原始 URL：服务器不一定把规范化后的写法当成同一个页面
+        key = self.normalize(url) if self.normalize is not None else url
+        if not self.seen.add(key):
+            self.duplicates += 1
+            return False
+        self._counter += 1
+        heapq.heappush(self._heap, (priority, self._counter, url))
+        if len(self._heap) >= self.memory_items:
+            self._spill()
+        return True
+
+    def pop(self):
+        """
+        :return: 优先级最高的 URL，队列为空时抛出 IndexError
+        """
+        if self._runs and (not self._heap or self._runs[0][0] < self._heap[0]):
+            entry, index, run = heapq.heappop(self._runs)
+            self.spilled -= 1
+            if run.advance() is not None:
+                heapq.heappush(self._runs, (run.head, index, run))
+            return entry[2]
+        if not self._heap:
+            raise IndexError("pop from empty frontier")
+        return heapq.heappop(self._heap)[2]
+
+    def drain(self):
+        """
+        :return: 按优先级依次弹出所有 URL 的生成器
+        """
+        while self:
+            yield self.pop()
+
+    def _spill(self):
+        if self._run_dir is None:
+            self._run_dir = tempfile.mkdtemp(prefix="frontier-", dir=self.spill_dir)
+        index = self._counter
+        path = os.path.join(self._run_dir, "run-%d" % index)
+        with open(path, "wb") as f:
+            for entry in sorted(self._heap):
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        self.spilled += len(self._heap)
+        self.spilled_total += len(self._heap)
+        self._heap = []
+        run = _Run(path)
+        heapq.heappush(self._runs, (run.head, index, run))
+
+    def close(self):
+        """
+        删除溢出文件
+        """
+        for _, _, run in self._runs:
+            run.close()
+        self._runs = []
+        self.spilled = 0
+        if self._run_dir is not None:
+            shutil.rmtree(self._run_dir, ignore_errors=True)
+            self._run_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,229 @@
+# coding=utf-8
+"""
+爬虫指标：计数器、直方图（抓取延迟、解析耗时、响应字节数）和按状态码的计数，
+可以输出 Prometheus 文本格式，也可以把每次抓取和解析写入 JSON lines 追踪文件
+"""
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = {
+    "fetch_seconds": (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    "parse_seconds": (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+    "response_bytes": (1024, 4096, 16384, 65536, 262144, 1048576, 4194304),
+}
+
+_NAME = re.compile(r"[^a-zA-Z0-9_:]")
+
+
+class Histogram(object):
+    """
+    固定分桶的直方图，只保存每个桶的计数，内存占用与观测次数无关
+    """
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)    # 最后一个桶是 +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        :return: 第 q 分位数所在桶的上界，落在 +Inf 桶时返回最大的有限上界
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return self.buckets[min(index, len(self.buckets) - 1)]
+        return self.buckets[-1]
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+
+class Metrics(object):
+    """
+    用法：
+        metrics = Metrics("html2pdf", trace_path="crawl.trace.jsonl", prometheus_path="crawl.prom")
+        metrics.record_fetch(url, response.status_code, seconds, len(response.content))
+        with metrics.timer("parse_seconds"):
+            parse(...)
+        print(metrics.summary())
+        metrics.close()         # 写出 Prometheus 文本并关闭追踪文件
+    """
+
+    def __init__(self, namespace="crawler", trace_path=None, prometheus_path=None, buckets=None):
+        """
+        :param namespace: Prometheus 指标名前缀
+        :param trace_path: JSON lines 追踪文件路径，为 None 时不记录
+        :param prometheus_path: close 时写出的 Prometheus 文本文件路径，为 None 时不写
+        :param buckets: 直方图名 -> 分桶上界，覆盖 DEFAULT_BUCKETS
+        """
+        self.namespace = _NAME.sub("_", namespace)
+        self.prometheus_path = prometheus_path
+        self.buckets = dict(DEFAULT_BUCKETS, **(buckets or {}))
+        self.counters = {}
+        self.histograms = {}
+        self.statuses = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._trace = open(trace_path, "a", encoding="utf-8") if trace_path else None
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(self.buckets.get(name, DEFAULT_BUCKETS["fetch_seconds"]))
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def trace(self, event, **fields):
+        """
+        向追踪文件写一行 JSON，没有指定追踪文件时什么也不做
+        """
+        fields["event"] = event
+        fields["time"] = round(time.time(), 6)
+        line = json.dumps(fields, ensure_ascii=False)
+        # close 在锁内把 _trace 置为 None，检查也必须在锁内
+        with self._lock:
+            if self._trace is not None:
+                self._trace.write(line + "\n")
+
+    def record_fetch(self, url, status, seconds, nbytes=0, cached=False, error=None):
+        """
+        记录一次请求
+        :param status: HTTP 状态码，请求出错时为 None
+        :param cached: 正文是否来自本地缓存
+        :param error: 请求出错时的异常
+        """
+        label = str(status) if status is not None else "error"
+        with self._lock:
+            self.statuses[label] = self.statuses.get(label, 0) + 1
+        self.inc("requests")
+        if cached:
+            self.inc("cache_hits")
+        if error is not None:
+            self.inc("errors")
+        self.observe("fetch_seconds", seconds)
+        if nbytes:
+            self.inc("bytes", nbytes)
+            self.observe("response_bytes", nbytes)
+        self.trace("fetch", url=url, status=status, seconds=round(seconds, 6), bytes=nbytes, cached=cached,
+                   error=repr(error) if error is not None else None)
+
+    def record_parse(self, url, seconds, cpu_seconds=None):
+        self.inc("pages")
+        self.observe("parse_seconds", seconds)
+        self.trace("parse", url=url, seconds=round(seconds, 6),
+                   cpu_seconds=round(cpu_seconds, 6) if cpu_seconds is not None else None)
+
+    def prometheus(self):
+        """
+        :return: Prometheus 文本格式的全部指标
+        """
+        prefix = self.namespace + "_"
+        lines = []
+        with self._lock:
+            for name in sorted(self.counters):
+                metric = prefix + _NAME.sub("_", name) + "_total"
+                lines.append("# TYPE %s counter" % metric)
+                lines.append("%s %s" % (metric, self.counters[name]))
+            if self.statuses:
+                metric = prefix + "responses_total"
+                lines.append("# TYPE %s counter" % metric)
+                for status in sorted(self.statuses):
+                    lines.append('%s{status="%s"} %d' % (metric, status, self.statuses[status]))
+            for name in sorted(self.histograms):
+                histogram = self.histograms[name]
+                metric = prefix + _NAME.sub("_", name)
+                lines.append("# TYPE %s histogram" % metric)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket{le="%s"} %d' % (metric, repr(float(bound)), cumulative))
+                lines.append('%s_bucket{le="+Inf"} %d' % (metric, histogram.count))
+                lines.append("%s_sum %r" % (metric, histogram.sum))
+                lines.append("%s_count %d" % (metric, histogram.count))
+            metric = prefix + "uptime_seconds"
+            lines.append("# TYPE %s gauge" % metric)
+            lines.append("%s %r" % (metric, round(time.time() - self.started, 3)))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path=None):
+        """
+        先写临时文件再替换，node_exporter 的 textfile 收集器不会读到写了一半的文件
+        """
+        path = path or self.prometheus_path
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, path)
+
+    def summary(self):
+        """
+        :return: 适合打印到终端的多行摘要
+        """
+        lines = []
+        with self._lock:
+            fetch = self.histograms.get("fetch_seconds")
+            parse = self.histograms.get("parse_seconds")
+            if fetch is not None:
+                lines.append(u"抓取：%d 次请求，p50 ≤ %.0f 毫秒，p99 ≤ %.0f 毫秒，平均 %.1f 毫秒，共 %d 字节" % (
+                    fetch.count, fetch.quantile(0.5) * 1000, fetch.quantile(0.99) * 1000, fetch.mean * 1000,
+                    self.counters.get("bytes", 0)))
+            if self.statuses:
+                lines.append(u"状态码：" + u"，".join(
+                    u"%s × %d" % (status, self.statuses[status]) for status in sorted(self.statuses)))
+            if parse is not None:
+                lines.append(u"解析：%d 页，共 %.3f 秒，p50 ≤ %.1f 毫秒，p99 ≤ %.1f 毫秒" % (
+                    parse.count, parse.sum, parse.quantile(0.5) * 1000, parse.quantile(0.99) * 1000))
+        return u"\n".join(lines)
+
+    def close(self):
+        if self.prometheus_path:
+            self.write_prometheus()
+        if self._trace is not None:
+            with self._lock:
+                self._trace.close()
+                self._trace = None
+
+
+_default_metrics = None
+_default_lock = threading.Lock()
+
+
+def get_metrics(**kwargs):
+    """
+    返回进程内共享的指标，第一次调用时按 kwargs 创建
+    """
+    global _default_metrics
+    with _default_lock:
+        if _default_metrics is None:
+            _default_metrics = Metrics(**kwargs)
+        return _default_metrics
@@ -0,0 +1,15 @@
+# coding=utf-8
+"""
+进程池的启动方式：进程池往往在抓取线程已经运行之后才创建，
+这时用 fork 创建子进程，子进程会继承被其他线程持有的锁（logging、连接池等）而死锁，
+所以改用 forkserver（不支持时用 spawn）启动子进程
+"""
+import multiprocessing
+
+
+def pool_context():
+    """
+    :return: 传给 ProcessPoolExecutor(mp_context=...) 的 multiprocessing 上下文
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
@@ -0,0 +1,225 @@
+# coding=utf-8
+"""
+礼貌抓取调度：每个域名一个令牌桶，遵守配置的抓取间隔和 robots.txt 中的 Crawl-delay，
+并把不同域名的 URL 交错排列，单个站点不超限的同时保持总吞吐量
+"""
+import heapq
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+try:
+    from urllib.parse import urlparse   # py3
+    from urllib.robotparser import RobotFileParser
+except ImportError:
+    from urlparse import urlparse
+    from robotparser import RobotFileParser
+
+import requests
+
+_END = object()     # interleave 中表示 urls 已经取完
+
+
+class TokenBucket(object):
+    """
+    令牌桶：每秒补充 rate 个令牌，最多积攒 capacity 个。
+    reserve 预支一个令牌，返回需要等待的秒数，令牌可以为负数，并发的请求按预约顺序排队
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class _Domain(object):
+
+    def __init__(self, host, concurrency):
+        self.host = host
+        self.slot = threading.BoundedSemaphore(concurrency)
+        self.lock = threading.Lock()
+        self.robots = None
+        self.bucket = None
+        self.interval = 0.0
+
+
+class PolitenessScheduler(object):
+    """
+    用法：
+        scheduler = PolitenessScheduler(crawl_delay=1.0)
+        for url in scheduler.interleave(urls):
+            with scheduler.hold(url):
+                session.get(url)
+    """
+
+    def __init__(self, crawl_delay=0.0, rate=None, burst=1, concurrency=4, robots=True,
+                 user_agent="*", session=None, robots_timeout=10):
+        """
+        :param crawl_delay: 同一域名相邻两次请求之间的最小间隔（秒）
+        :param rate: 同一域名每秒最多请求数，为 None 时只受 crawl_delay 限制
+        :param burst: 令牌桶容量，空闲一段时间后允许连续发出的请求数；robots.txt 指定了 Crawl-delay 时为 1
+        :param concurrency: 同一域名同时进行的最大请求数
+        :param robots: 是否读取 robots.txt 的 Crawl-delay / Request-rate 和抓取规则
+        :param user_agent: 匹配 robots.txt 规则时使用的 User-agent
+        :param session: 下载 robots.txt 使用的会话，默认为 requests
+        """
+        self.crawl_delay = crawl_delay
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.robots = robots
+        self.user_agent = user_agent
+        self.session = session or requests
+        self.robots_timeout = robots_timeout
+        self._lock = threading.Lock()
+        self._domains = {}
+
+    def _domain(self, url):
+        parsed = urlparse(url)
+        with self._lock:
+            domain = self._domains.get(parsed.netloc)
+            if domain is None:
+                domain = self._domains[parsed.netloc] = _Domain(parsed.netloc, self.concurrency)
+        # 每个域名只配置一次，robots.txt 在域名自己的锁里下载，不阻塞其他域名
+        with domain.lock:
+            if domain.bucket is None:
+                self._configure(domain, parsed.scheme or "http")
+        return domain
+
+    def _configure(self, domain, scheme):
+        interval = self.crawl_delay
+        if self.rate:
+            interval = max(interval, 1.0 / self.rate)
+        burst = self.burst
+        if self.robots:
+            domain.robots = self._read_robots("%s://%s/robots.txt" % (scheme, domain.host))
+            # urllib.robotparser 只识别整数秒的 Crawl-delay，小数会被忽略
+            delay = domain.robots.crawl_delay(self.user_agent)
+            if delay:
+                interval = max(interval, float(delay))
+                burst = 1
+            request_rate = domain.robots.request_rate(self.user_agent)
+            if request_rate and request_rate.requests:
+                interval = max(interval, float(request_rate.seconds) / request_rate.requests)
+        domain.interval = interval
+        domain.bucket = TokenBucket(1.0 / interval, burst) if interval > 0 else False
+
+    def _read_robots(self, url):
+        parser = RobotFileParser(url)
+        try:
+            response = self.session.get(url, timeout=self.robots_timeout)
+        except requests.RequestException:
+            response = None
+        if response is None or response.status_code >= 500:
+            lines = []
+        elif response.status_code in (401, 403):
+            lines = ["User-agent: *", "Disallow: /"]
+        elif response.status_code >= 400:
+            lines = []
+        else:
+            lines = response.text.splitlines()
+        parser.parse(lines)
+        return parser
+
+    def allowed(self, url):
+        """
+        :return: robots.txt 是否允许抓取 url
+        """
+        domain = self._domain(url)
+        return domain.robots is None or domain.robots.can_fetch(self.user_agent, url)
+
+    def interval(self, url):
+        """
+        :return: url 所在域名实际使用的请求间隔（秒）
+        """
+        return self._domain(url).interval
+
+    @contextmanager
+    def hold(self, url):
+        """
+        占用 url 所在域名的一个请求名额，并等到令牌桶允许发出请求
+        """
+        domain = self._domain(url)
+        domain.slot.acquire()
+        try:
+            if domain.bucket:
+                wait = domain.bucket.reserve()
+                if wait > 0:
+                    time.sleep(wait)
+            yield
+        finally:
+            domain.slot.release()
+
+    def interleave(self, urls, window=1024):
+        """
+        把 urls 按各域名最早可以请求的时间重新排列，同一域名的 URL 保持原来的相对顺序。
+        只看 window 个 URL，可以用于很长的或者流式的 URL 序列。
+        流式的 urls 可以产出 None 表示暂时没有新的 URL，这时先把已缓冲的 URL 发出去，
+        缓冲区空了才再向 urls 取，不会等凑满 window 个才开始
+        :return: URL 生成器
+        """
+        queues = OrderedDict()
+        heap = []           # (预计可以请求的时间, 序号, 域名)
+        ready = {}          # 域名 -> 下一次预计可以请求的时间
+        buffered = 0
+        counter = 0
+        urls = iter(urls)
+        exhausted = False
+        starved = False     # urls 上一次产出了 None
+        while True:
+            while not exhausted and buffered < window and not (starved and heap):
+                url = next(urls, _END)
+                if url is _END:
+                    exhausted = True
+                    break
+                starved = url is None
+                if starved:
+                    continue
+                host = urlparse(url).netloc
+                queue = queues.get(host)
+                if queue is None:
+                    queue = queues[host] = deque()
+                if not queue:
+                    counter += 1
+                    heapq.heappush(heap, (ready.get(host, 0.0), counter, host))
+                queue.append(url)
+                buffered += 1
+            if not heap:
+                return
+            at, _, host = heapq.heappop(heap)
+            queue = queues[host]
+            url = queue.popleft()
+            buffered -= 1
+            ready[host] = at + self._domain(url).interval
+            if queue:
+                counter += 1
+                heapq.heappush(heap, (ready[host], counter, host))
+            else:
+                del queues[host]
+            yield url
+
+
+_default_scheduler = None
+_default_lock = threading.Lock()
+
+
+def get_scheduler(**kwargs):
+    """
+    返回进程内共享的调度器，第一次调用时按 kwargs 创建
+    """
+    global _default_scheduler
+    with _default_lock:
+        if _default_scheduler is None:
+            _default_scheduler = PolitenessScheduler(**kwargs)
+        return _default_scheduler
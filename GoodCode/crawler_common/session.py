@@ -0,0 +1,102 @@
+# coding=utf-8
+"""
+共享的 HTTP 会话层：连接池 + keep-alive + gzip，并统计连接复用率和传输字节数
+"""
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class PooledSession(object):
+    """
+    基于 requests.Session 的连接池会话，可以在多个线程之间共享
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=32, keep_alive=True, gzip=True, timeout=30):
+        """
+        :param pool_connections: 缓存的主机连接池个数
+        :param pool_maxsize: 每个主机连接池保留的最大连接数，应不小于并发数
+        :param keep_alive: 是否复用 TCP 连接
+        :param gzip: 是否请求 gzip 压缩的响应
+        :param timeout: 默认超时时间（秒）
+        """
+        self.timeout = timeout
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        self.session.headers["Connection"] = "keep-alive" if keep_alive else "close"
+        self.session.headers["Accept-Encoding"] = "gzip, deflate" if gzip else "identity"
+
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.bytes_received = 0     # 网络上实际传输的字节数（压缩后）
+        self.bytes_decoded = 0      # 解压后的正文字节数
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        response = self.session.request(method, url, **kwargs)
+        if kwargs.get("stream"):
+            with self._lock:
+                self.requests += 1
+            return response
+        content = response.content  # 读完正文后连接才会归还到连接池
+        try:
+            received = response.raw.tell()
+        except (AttributeError, ValueError):
+            received = len(content)
+        with self._lock:
+            self.requests += 1
+            self.bytes_received += received
+            self.bytes_decoded += len(content)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request("POST", url, data=data, **kwargs)
+
+    @property
+    def connections(self):
+        """
+        新建的 TCP 连接数（只统计仍在缓存中的主机连接池）
+        """
+        pools = self.adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in pools.keys())
+
+    def stats(self):
+        """
+        :return: 请求数、新建连接数、连接复用率、传输字节数
+        """
+        connections = self.connections
+        with self._lock:
+            requests_count = self.requests
+            received, decoded = self.bytes_received, self.bytes_decoded
+        reuse = 1 - float(connections) / requests_count if requests_count else 0.0
+        return {
+            "requests": requests_count,
+            "connections": connections,
+            "reuse_ratio": max(0.0, reuse),
+            "bytes_received": received,
+            "bytes_decoded": decoded,
+        }
+
+    def close(self):
+        self.session.close()
+
+
+_default_session = None
+_default_lock = threading.Lock()
+
+
+def get_session(**kwargs):
+    """
+    返回进程内共享的会话，第一次调用时按 kwargs 创建
+    """
+    global _default_session
+    with _default_lock:
+        if _default_session is None:
+            _default_session = PooledSession(**kwargs)
+        return _default_session
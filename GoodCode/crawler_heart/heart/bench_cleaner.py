@@ -0,0 +1,85 @@
+# -*- coding:utf-8 -*-
+"""
+比较 TextCleaner 与原来的 cleanring 函数的清洗速度
+
+用法：
+    python bench_cleaner.py                 # 使用 weibo.csv 中的微博
+    python bench_cleaner.py --size 100000   # 语料不足时用样例微博补足到 size 条
+"""
+import argparse
+import codecs
+import csv
+import re
+import time
+
+from cleaner import TextCleaner
+
+SAMPLES = [
+    u'转发微博 //:<a href="/n/xxx">@某人</a>：今天天气不错，一起去爬山吧！',
+    u'分享图片 <i class="face face_1 icon_1">[微笑]</i>晚饭吃了火锅。真开心、明天继续？',
+    u'Repost 这个教程写得真好，推荐给大家 <a href="http://t.cn/abc">网页链接</a>',
+    u'程序员的日常：写代码、改 bug、开会，周而复始。',
+]
+
+
+def cleanring(content):
+    """
+    原来在 fetch_weibo 中每条微博都重新定义一次的清洗函数
+    """
+    pattern = "<a .*?/a>|<i .*?/i>|转发微博|//:|Repost|，|？|。|、|分享图片"
+    content = re.sub(pattern, "", content)
+    return content
+
+
+def load_texts(path, size):
+    with codecs.open(path, 'r', encoding='utf-8') as f:
+        texts = [row['text'] for row in csv.DictReader(f)]
+    print(u"%s 中有 %d 条微博" % (path, len(texts)))
+    pool = texts or SAMPLES
+    while len(texts) < size:
+        texts.append(pool[len(texts) % len(pool)])
+    return texts
+
+
+def bench(func, texts, rounds):
+    start = time.time()
+    for _ in range(rounds):
+        result = func(texts)
+    return (time.time() - start) / rounds, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=u"比较 TextCleaner 与 cleanring 的速度")
+    parser.add_argument("--csv", default="./weibo.csv")
+    parser.add_argument("--size", type=int, default=50000, help=u"语料不足时补足到的条数")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--batch", type=int, default=256, help=u"clean_batch 每批的条数")
+    args = parser.parse_args()
+
+    texts = load_texts(args.csv, args.size)
+    cleaner = TextCleaner()
+
+    def legacy(texts):
+        return [cleanring(text).strip() for text in texts]
+
+    def single(texts):
+        return [cleaner.clean(text) for text in texts]
+
+    def batched(texts):
+        result = []
+        for i in range(0, len(texts), args.batch):
+            result.extend(cleaner.clean_batch(texts[i:i + args.batch]))
+        return result
+
+    bench(legacy, texts, 1)     # 预热
+    baseline, expected = bench(legacy, texts, args.rounds)
+    print(u"%-24s %10s %8s  %s" % (u"方式", u"毫秒", u"加速比", u"结果一致"))
+    print(u"%-24s %10.1f %7.2fx  %s" % (u"cleanring", baseline * 1000, 1.0, u"是"))
+    for name, func in ((u"TextCleaner.clean", single), (u"TextCleaner.clean_batch", batched)):
+        seconds, result = bench(func, texts, args.rounds)
+        print(u"%-24s %10.1f %7.2fx  %s" % (name, seconds * 1000, baseline / seconds,
+                                           u"是" if result == expected else u"否"))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+# -*- coding:utf-8 -*-
+"""
+微博文本清洗：规则只编译一次，每条文本只扫描一遍，可以批量处理
+"""
+import re
+
+# 默认去掉的内容：链接、表情、转发标记和部分中文标点
+DEFAULT_RULES = ("<a .*?/a>", "<i .*?/i>", "转发微博", "//:", "Repost", "，", "？", "。", "、", "分享图片")
+
+# 批量清洗时文本之间的分隔符，规则中的 "." 不匹配换行，不会跨过分隔符
+SEPARATOR = "\n\x1e\n"
+
+
+class TextCleaner(object):
+    """
+    用法：
+        cleaner = TextCleaner()
+        cleaner.clean(text)
+        cleaner.clean_batch(texts)
+    """
+
+    def __init__(self, rules=DEFAULT_RULES):
+        """
+        :param rules: 要删除的内容，每条是一个正则表达式，不能匹配换行符
+        """
+        self.rules = tuple(rules)
+        self.pattern = re.compile("|".join(self.rules))
+
+    def clean(self, text):
+        """
+        :return: 去掉无用字符并去掉首尾空白后的文本
+        """
+        return self.pattern.sub("", text).strip()
+
+    def clean_batch(self, texts):
+        """
+        把一批文本拼接起来只调用一次正则替换，再拆分回去
+        :param texts: 文本列表
+        :return: 清洗后的文本列表，与 texts 一一对应
+        """
+        if not texts:
+            return []
+        if any("\x1e" in text for text in texts):
+            return [self.clean(text) for text in texts]
+        cleaned = self.pattern.sub("", SEPARATOR.join(texts)).split(SEPARATOR)
+        return [text.strip() for text in cleaned]
@@ -0,0 +1,172 @@
+# -*- coding:utf-8 -*-
+"""
+压缩的语料库存储，代替 weibo.csv
+
+数据文件 <path> 由若干个块组成，每个块：
+    1 字节压缩方式 + 4 字节压缩后长度 + 压缩后的记录
+    每条记录为 4 字节长度 + utf-8 编码的文本
+索引文件 <path>.idx 每个块一项：块的偏移、块的字节数、块中第一条记录的序号、记录数
+
+写入时先写数据块再写索引，中途退出时没有写入索引的数据块会在下次追加时被截掉。
+"""
+import os
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+
+CHUNK_HEADER = struct.Struct(">BI")
+RECORD_LENGTH = struct.Struct(">I")
+INDEX_ENTRY = struct.Struct(">QIQI")
+
+
+def _compress(codec, data):
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return zlib.compress(data, 6)
+
+
+def _decompress(codec, data):
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("corpus chunk is zstd-compressed but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def _read_index(path):
+    """
+    :return: [(偏移, 块字节数, 第一条记录的序号, 记录数)]
+    """
+    entries = []
+    if not os.path.exists(path):
+        return entries
+    with open(path, "rb") as f:
+        data = f.read()
+    # 忽略最后一项写了一半的索引
+    usable = len(data) - len(data) % INDEX_ENTRY.size
+    for offset in range(0, usable, INDEX_ENTRY.size):
+        entries.append(INDEX_ENTRY.unpack_from(data, offset))
+    return entries
+
+
+class CorpusWriter(object):
+    """
+    追加写入语料：
+        with CorpusWriter("weibo.corpus") as writer:
+            writer.extend(texts)
+    """
+
+    def __init__(self, path, chunk_records=1024, codec=None):
+        """
+        :param path: 数据文件路径，已存在时在末尾追加
+        :param chunk_records: 每个块包含的记录数
+        :param codec: CODEC_ZSTD 或 CODEC_ZLIB，默认安装了 zstandard 时使用 zstd
+        """
+        self.path = path
+        self.index_path = path + ".idx"
+        self.chunk_records = chunk_records
+        self.codec = codec or (CODEC_ZSTD if zstandard is not None else CODEC_ZLIB)
+        if self.codec == CODEC_ZSTD and zstandard is None:
+            raise RuntimeError("zstandard is not installed")
+
+        if not os.path.exists(self.index_path) and os.path.exists(path) and os.path.getsize(path):
+            raise ValueError("%s has no index file %s" % (path, self.index_path))
+        entries = _read_index(self.index_path)
+        end = entries[-1][0] + entries[-1][1] if entries else 0
+        self.count = entries[-1][2] + entries[-1][3] if entries else 0
+        # 截掉上次中途退出时留下的、没有写入索引的数据
+        with open(self.index_path, "ab") as f:
+            f.truncate(len(entries) * INDEX_ENTRY.size)
+        self._data = open(path, "ab")
+        self._data.truncate(end)
+        self._index = open(self.index_path, "ab")
+        self._offset = end
+        self._records = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def append(self, text):
+        data = text.encode("utf-8")
+        self._records.append(RECORD_LENGTH.pack(len(data)) + data)
+        if len(self._records) >= self.chunk_records:
+            self.flush()
+
+    def extend(self, texts):
+        for text in texts:
+            self.append(text)
+
+    def flush(self):
+        """
+        把缓冲的记录压缩成一个块写入文件
+        """
+        if not self._records:
+            return
+        blob = _compress(self.codec, b"".join(self._records))
+        chunk = CHUNK_HEADER.pack(self.codec, len(blob)) + blob
+        self._data.write(chunk)
+        self._data.flush()
+        self._index.write(INDEX_ENTRY.pack(self._offset, len(chunk), self.count, len(self._records)))
+        self._index.flush()
+        self._offset += len(chunk)
+        self.count += len(self._records)
+        self._records = []
+
+    def close(self):
+        self.flush()
+        self._data.close()
+        self._index.close()
+
+
+class CorpusReader(object):
+    """
+    逐块解压、逐条返回的语料读取器，不会一次读入整个文件：
+        for text in CorpusReader("weibo.corpus"):
+            ...
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = _read_index(path + ".idx")
+
+    def __len__(self):
+        if not self.entries:
+            return 0
+        return self.entries[-1][2] + self.entries[-1][3]
+
+    def __iter__(self):
+        return self.read()
+
+    def read(self, start=0):
+        """
+        从第 start 条记录开始逐条返回文本，借助索引直接定位到所在的块
+        """
+        if not self.entries:
+            return
+        with open(self.path, "rb") as f:
+            for offset, size, first, count in self.entries:
+                if first + count <= start:
+                    continue
+                f.seek(offset)
+                chunk = f.read(size)
+                codec, blob_length = CHUNK_HEADER.unpack_from(chunk)
+                data = _decompress(codec, chunk[CHUNK_HEADER.size:CHUNK_HEADER.size + blob_length])
+                pos = 0
+                number = first
+                while pos < len(data):
+                    (length,) = RECORD_LENGTH.unpack_from(data, pos)
+                    pos += RECORD_LENGTH.size
+                    if number >= start:
+                        yield data[pos:pos + length].decode("utf-8")
+                    pos += length
+                    number += 1
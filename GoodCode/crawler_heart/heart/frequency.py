@@ -0,0 +1,70 @@
+# -*- coding:utf-8 -*-
+"""
+增量词频统计：逐条累加分词结果，可以保存快照、合并快照，直接交给 WordCloud.generate_from_frequencies
+"""
+import json
+import os
+import tempfile
+from collections import Counter
+
+
+class WordFrequency(Counter):
+    """
+    用法：
+        frequency = WordFrequency.load("freq.json")     # 没有快照时为空
+        frequency.ingest(word_segment(texts))
+        frequency.save("freq.json")
+        wordcloud.generate_from_frequencies(frequency.top(200))
+    """
+
+    def add(self, tags):
+        """
+        :param tags: 一条文本的关键词列表，或者用空格分隔的关键词字符串
+        """
+        if isinstance(tags, str):
+            tags = tags.split()
+        self.update(tags)
+
+    def ingest(self, tag_lists):
+        """
+        逐条累加，不会把所有分词结果同时放在内存中
+        :return: self
+        """
+        for tags in tag_lists:
+            self.add(tags)
+        return self
+
+    def merge(self, other):
+        """
+        合并另一份词频（例如另一天的快照）
+        :return: self
+        """
+        self.update(other)
+        return self
+
+    def top(self, n):
+        """
+        :return: 出现次数最多的 n 个词及其次数
+        """
+        return dict(self.most_common(n))
+
+    def save(self, path):
+        """
+        保存快照，先写临时文件再替换，避免中途退出损坏快照
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(dict(self), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :return: 快照中的词频，快照不存在时返回空的 WordFrequency
+        """
+        frequency = cls()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                frequency.update(json.load(f))
+        return frequency
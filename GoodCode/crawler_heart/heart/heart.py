@@ -1,13 +1,25 @@
 # -*- coding:utf-8 -*-
 import codecs
 import csv
-import re
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import jieba.analyse
-import matplotlib.pyplot as plt
 import requests
-from scipy.misc import imread
-from wordcloud import WordCloud
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from crawler_common.metrics import get_metrics  # noqa: E402
+from crawler_common.processes import pool_context  # noqa: E402
+from crawler_common.ratelimit import get_scheduler  # noqa: E402
+from crawler_common.session import get_session  # noqa: E402
+from cleaner import TextCleaner  # noqa: E402
+from corpus import CorpusReader, CorpusWriter  # noqa: E402
+from frequency import WordFrequency  # noqa: E402
+from pipeline import Pipeline  # noqa: E402
+from render import CloudRenderer  # noqa: E402
 
 __author__ = 'liuzhijun'
 
@@ -26,29 +38,93 @@ cookies = {
 }
 
 
-def fetch_weibo():
-    api = "http://m.weibo.cn/index/my?format=cards&page=%s"
-    for i in range(1, 102):
-        response = requests.get(url=api % i, cookies=cookies)
-        data = response.json()[0]
-        groups = data.get("card_group") or []
-        for group in groups:
-            text = group.get("mblog").get("text")
-            text = text.encode("utf-8")
-
-            def cleanring(content):
-                """
-                去掉无用字符
-                """
-                pattern = "<a .*?/a>|<i .*?/i>|转发微博|//:|Repost|，|？|。|、|分享图片"
-                content = re.sub(pattern, "", content)
-                return content
-
-            text = cleanring(text).strip()
+api = "http://m.weibo.cn/index/my?format=cards&page=%s"
+
+# 去掉无用字符
+cleaner = TextCleaner()
+
+
+def fetch_page(session, page, retries=3, backoff=1.0, scheduler=None, metrics=None):
+    """
+    抓取一页微博，连接出错、超时、服务器返回 5xx 或者被限流（429）时按指数退避重试
+    :param scheduler: PolitenessScheduler，为 None 时不限速
+    :param metrics: 记录请求和解析耗时的 Metrics，默认使用进程内共享的 Metrics
+    :return: 该页的 card_group 列表，没有更多微博时为空列表
+    """
+    url = api % page
+    metrics = metrics or get_metrics()
+    for attempt in range(retries + 1):
+        start = time.time()
+        try:
+            if scheduler is None:
+                response = session.get(url, cookies=cookies)
+            else:
+                with scheduler.hold(url):
+                    start = time.time()
+                    response = session.get(url, cookies=cookies)
+        except requests.RequestException as e:
+            metrics.record_fetch(url, None, time.time() - start, error=e)
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+            continue
+        metrics.record_fetch(url, response.status_code, time.time() - start, len(response.content))
+        if response.status_code < 500 and response.status_code != 429:
+            break
+        if attempt == retries:
+            response.raise_for_status()
+        retry_after = response.headers.get("Retry-After", "")
+        time.sleep(int(retry_after) if retry_after.isdigit() else backoff * 2 ** attempt)
+    start = time.time()
+    data = response.json()[0]
+    metrics.record_parse(url, time.time() - start)
+    return data.get("card_group") or []
+
+
+def fetch_raw(pages=101, window=8, retries=3, backoff=1.0, scheduler=None):
+    """
+    并发抓取微博，最多同时抓取 window 页，按页码顺序返回，遇到空页后停止
+    :param scheduler: PolitenessScheduler，默认使用进程内共享的调度器
+    :return: 每页未经清洗的微博文本列表的生成器
+    """
+    session = get_session()
+    scheduler = scheduler or get_scheduler(session=session)
+    page_numbers = iter(range(1, pages + 1))
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        def submit_next():
+            for page in page_numbers:
+                pending.append(executor.submit(fetch_page, session, page, retries, backoff, scheduler))
+                return
+
+        for _ in range(window):
+            submit_next()
+        try:
+            while pending:
+                groups = pending.popleft().result()
+                if not groups:
+                    break
+                submit_next()
+                yield [group.get("mblog").get("text") for group in groups]
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def clean_texts(batches):
+    """
+    按页批量清洗，去掉清洗后为空的微博
+    """
+    for texts in batches:
+        for text in cleaner.clean_batch(texts):
             if text:
                 yield text
 
 
+def fetch_weibo(pages=101, window=8, retries=3, backoff=1.0, scheduler=None):
+    return clean_texts(fetch_raw(pages, window, retries, backoff, scheduler))
+
+
 def write_csv(texts):
     with codecs.open('./weibo.csv', 'w') as f:
         writer = csv.DictWriter(f, fieldnames=["text"])
@@ -64,28 +140,136 @@ def read_csv():
             yield row['text']
 
 
-def word_segment(texts):
-    jieba.analyse.set_stop_words("./stopwords.txt")
+def _init_segment_worker(stop_words):
+    """
+    分词进程启动时加载一次词典和停用词
+    """
+    jieba.initialize()
+    jieba.analyse.set_stop_words(stop_words)
+
+
+def _segment_chunk(texts):
+    return [" ".join(jieba.analyse.extract_tags(text, topK=20)) for text in texts]
+
+
+def _chunked(texts, size):
+    chunk = []
     for text in texts:
-        tags = jieba.analyse.extract_tags(text, topK=20)
-        yield " ".join(tags)
+        chunk.append(text)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
 
+def write_corpus(texts, path='./weibo.corpus'):
+    """
+    把微博追加写入压缩的语料库
+    """
+    with CorpusWriter(path) as writer:
+        writer.extend(texts)
 
-def generate_img(texts):
-    data = " ".join(text for text in texts)
 
-    mask_img = imread('./heart-mask.jpg', flatten=True)
-    wordcloud = WordCloud(
-        font_path='msyh.ttc',
-        background_color='white',
-        mask=mask_img
-    ).generate(data)
-    plt.imshow(wordcloud)
-    plt.axis('off')
-    plt.savefig('./heart.jpg', dpi=600)
+def read_corpus(path='./weibo.corpus'):
+    for text in CorpusReader(path):
+        yield text
+
+
+def word_segment(texts, processes=None, chunksize=64, stop_words="./stopwords.txt"):
+    """
+    多进程提取关键词，texts 按 chunksize 分块交给各个进程，结果按输入顺序返回
+    :param processes: 分词进程数，默认为 CPU 核数，1 表示在当前进程中分词
+    """
+    processes = processes or os.cpu_count() or 1
+    if processes == 1:
+        _init_segment_worker(stop_words)
+        for chunk in _chunked(texts, chunksize):
+            for tags in _segment_chunk(chunk):
+                yield tags
+        return
+
+    pending = deque()
+    # word_segment 作为流水线的一段运行在线程里，此时不能直接 fork
+    with ProcessPoolExecutor(max_workers=processes, mp_context=pool_context(),
+                             initializer=_init_segment_worker, initargs=(stop_words,)) as executor:
+        try:
+            for chunk in _chunked(texts, chunksize):
+                pending.append(executor.submit(_segment_chunk, chunk))
+                # 最多保留 2 * processes 个未完成的块，避免一次读入整个语料
+                if len(pending) >= processes * 2:
+                    for tags in pending.popleft().result():
+                        yield tags
+            while pending:
+                for tags in pending.popleft().result():
+                    yield tags
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+_renderer = None
+
+
+def get_renderer():
+    """
+    进程内共享的渲染器，蒙版和字体只加载一次
+    """
+    global _renderer
+    if _renderer is None:
+        _renderer = CloudRenderer()
+    return _renderer
+
+
+def generate_img(texts, snapshot=None, max_words=200, output='./heart.jpg'):
+    """
+    :param texts: 分词结果，每条为空格分隔的关键词
+    :param snapshot: 词频快照文件，指定时在已有的词频上累加并保存，只需要处理新增的微博
+    :param max_words: 词云中最多显示的词数
+    :param output: 输出图片路径
+    """
+    frequency = WordFrequency.load(snapshot) if snapshot else WordFrequency()
+    frequency.ingest(texts)
+    if snapshot:
+        frequency.save(snapshot)
+    render_img(frequency, max_words, output)
+
+
+def render_img(frequency, max_words=200, output='./heart.jpg'):
+    get_renderer().render(frequency.top(max_words), output, './heart-mask.jpg', max_words=max_words)
+
+
+def run_pipeline(queue_size=64, spill_dir=None, corpus=None, snapshot=None, max_words=200):
+    """
+    抓取、清洗、分词、统计词频四个阶段同时运行，最后生成词云
+    :param queue_size: 阶段之间每个队列在内存中保留的最大元素数
+    :param spill_dir: 队列满时把多出的数据暂存到这个目录，为 None 时上游等待
+    :param corpus: 同时把清洗后的微博追加到这个语料库文件，为 None 时不保存
+    :param snapshot: 词频快照文件，在已有的词频上累加并保存
+    """
+    def store(texts):
+        with CorpusWriter(corpus) as writer:
+            for text in texts:
+                writer.append(text)
+                yield text
+
+    pipeline = Pipeline(queue_size, spill_dir)
+    pipeline.source("fetch", fetch_raw)
+    pipeline.stage("clean", clean_texts)
+    if corpus:
+        pipeline.stage("store", store)
+    pipeline.stage("segment", word_segment)
+    frequency = WordFrequency.load(snapshot) if snapshot else WordFrequency()
+    pipeline.run("aggregate", frequency.ingest)
+    pipeline.report()
+    metrics = get_metrics()
+    print(metrics.summary())
+    metrics.close()
+    if snapshot:
+        frequency.save(snapshot)
+    render_img(frequency, max_words)
 
 
 if __name__ == '__main__':
-    texts = fetch_weibo()
-    write_csv(texts)
-    generate_img(word_segment(read_csv()))
+    get_metrics(namespace="heart", trace_path="./heart.trace.jsonl", prometheus_path="./heart.prom")
+    run_pipeline(corpus='./weibo.corpus')
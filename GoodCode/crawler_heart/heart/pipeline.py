@@ -0,0 +1,252 @@
+# -*- coding:utf-8 -*-
+"""
+流水线：每个阶段运行在单独的线程中，阶段之间用有界队列连接，各阶段同时运行。
+队列满时上游阻塞等待；指定 spill_dir 时改为把多出来的数据暂存到磁盘，上游不再等待。
+运行结束后输出各阶段的吞吐量和队列深度。
+"""
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import deque
+
+_END = object()
+
+
+class SpillQueue(object):
+    """
+    先进先出的有界队列。内存中最多保留 maxsize 个元素；
+    指定 spill_dir 时，超出的元素按顺序写入临时文件，取完内存中的元素后再从文件中读取
+    """
+
+    def __init__(self, maxsize, spill_dir=None):
+        self.maxsize = maxsize
+        self.spill_dir = spill_dir
+        self.spilled = 0            # 当前在磁盘上的元素个数
+        self.spilled_total = 0
+        self.max_depth = 0
+        self._depth_sum = 0
+        self._depth_samples = 0
+        self._memory = deque()
+        self._ended = False
+        self._cond = threading.Condition()
+        self._writer = None
+        self._reader = None
+        self._spill_path = None
+
+    def __len__(self):
+        return len(self._memory) + self.spilled
+
+    @property
+    def mean_depth(self):
+        return float(self._depth_sum) / self._depth_samples if self._depth_samples else 0.0
+
+    def put(self, item, stop=None):
+        """
+        :param stop: threading.Event，置位后不再放入（也不再溢出到磁盘），返回 False
+        """
+        with self._cond:
+            if stop is not None and stop.is_set():
+                return False
+            if self.spill_dir is None:
+                while len(self._memory) >= self.maxsize:
+                    if stop is not None and stop.is_set():
+                        return False
+                    self._cond.wait(0.1)
+                self._memory.append(item)
+            elif self.spilled or len(self._memory) >= self.maxsize:
+                self._spill(item)
+            else:
+                self._memory.append(item)
+            depth = len(self)
+            self.max_depth = max(self.max_depth, depth)
+            self._depth_sum += depth
+            self._depth_samples += 1
+            self._cond.notify_all()
+            return True
+
+    def end(self):
+        """
+        上游已经结束，取完剩余的元素后 get 返回 _END
+        """
+        with self._cond:
+            self._ended = True
+            self._cond.notify_all()
+
+    def get(self, stop=None):
+        """
+        :return: 下一个元素，上游已经结束或者 stop 置位时返回 _END
+        """
+        with self._cond:
+            while not self._memory and not self.spilled:
+                if self._ended or (stop is not None and stop.is_set()):
+                    return _END
+                self._cond.wait(0.1)
+            if self._memory:
+                item = self._memory.popleft()
+            else:
+                item = self._unspill()
+            self._cond.notify_all()
+            return item
+
+    def _spill(self, item):
+        if self._writer is None:
+            fd, self._spill_path = tempfile.mkstemp(prefix="spill-", dir=self.spill_dir)
+            self._writer = os.fdopen(fd, "wb")
+            self._reader = open(self._spill_path, "rb")
+        pickle.dump(item, self._writer, pickle.HIGHEST_PROTOCOL)
+        self._writer.flush()
+        self.spilled += 1
+        self.spilled_total += 1
+
+    def _unspill(self):
+        item = pickle.load(self._reader)
+        self.spilled -= 1
+        if not self.spilled:
+            # 磁盘上的元素已经取完，删除文件，下次溢出时重新创建
+            self.close()
+        return item
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._reader.close()
+            os.remove(self._spill_path)
+            self._writer = self._reader = None
+
+
+class StageStats(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.started = None
+        self.finished = None
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def throughput(self):
+        return self.items / self.elapsed if self.elapsed else 0.0
+
+
+class Pipeline(object):
+    """
+    用法：
+        pipeline = Pipeline(queue_size=64)
+        pipeline.source("fetch", fetch_raw)             # 无参数函数，返回可迭代对象
+        pipeline.stage("clean", clean_texts)            # 接收上游的迭代器，返回可迭代对象
+        pipeline.stage("segment", word_segment)
+        result = pipeline.run("aggregate", WordFrequency().ingest)   # 消费最后的迭代器，返回结果
+        pipeline.report()
+    """
+
+    def __init__(self, queue_size=64, spill_dir=None):
+        """
+        :param queue_size: 每个队列在内存中保留的最大元素数
+        :param spill_dir: 溢出文件目录，为 None 时队列满了上游等待
+        """
+        self.queue_size = queue_size
+        self.spill_dir = spill_dir
+        self.stats = []
+        self.queues = []
+        self._stages = []
+        self._stop = threading.Event()
+        self._errors = []
+
+    def source(self, name, func):
+        self._stages.append((name, lambda _: func()))
+        return self
+
+    def stage(self, name, func):
+        self._stages.append((name, func))
+        return self
+
+    def _drain(self, queue):
+        # 某个阶段出错后立即停止向下游供数据，队列中剩余的元素直接丢弃
+        while not self._stop.is_set():
+            item = queue.get(self._stop)
+            if item is _END:
+                return
+            yield item
+
+    def _counted(self, items, stats):
+        for item in items:
+            stats.items += 1
+            yield item
+
+    def _run_stage(self, func, inq, outq, stats):
+        stats.started = time.time()
+        items = None
+        try:
+            items = func(self._drain(inq) if inq is not None else None)
+            for item in self._counted(items, stats):
+                if self._stop.is_set() or not outq.put(item, self._stop):
+                    break
+        except Exception as e:
+            self._errors.append((stats.name, e))
+            self._stop.set()
+        finally:
+            # 提前退出时关闭生成器，让它的 finally（例如取消未完成的抓取）立即执行
+            if hasattr(items, "close"):
+                items.close()
+            stats.finished = time.time()
+            outq.end()
+
+    def run(self, name, sink):
+        """
+        启动所有阶段，在当前线程中运行最后一个阶段
+        :param sink: 消费最后一个队列的函数，它的返回值就是 run 的返回值
+        """
+        threads = []
+        inq = None
+        for stage_name, func in self._stages:
+            outq = SpillQueue(self.queue_size, self.spill_dir)
+            stats = StageStats(stage_name)
+            thread = threading.Thread(target=self._run_stage, args=(func, inq, outq, stats), name=stage_name)
+            thread.daemon = True
+            threads.append(thread)
+            self.stats.append(stats)
+            self.queues.append(outq)
+            inq = outq
+
+        sink_stats = StageStats(name)
+        self.stats.append(sink_stats)
+        for thread in threads:
+            thread.start()
+        sink_stats.started = time.time()
+        try:
+            result = sink(self._counted(self._drain(inq), sink_stats))
+        except BaseException:
+            self._stop.set()
+            raise
+        finally:
+            sink_stats.finished = time.time()
+            for thread in threads:
+                thread.join()
+            for queue in self.queues:
+                queue.close()
+        if self._errors:
+            stage_name, error = self._errors[0]
+            raise RuntimeError(u"阶段 %s 出错：%r" % (stage_name, error)) from error
+        return result
+
+    def report(self):
+        """
+        打印各阶段处理的元素数、吞吐量以及输出队列的深度
+        """
+        print(u"%-12s %10s %10s %12s %10s %10s %10s" % (
+            u"阶段", u"元素数", u"耗时(秒)", u"吞吐量(/秒)", u"队列峰值", u"队列均值", u"溢出数"))
+        for index, stats in enumerate(self.stats):
+            if index < len(self.queues):
+                queue = self.queues[index]
+                depth = (queue.max_depth, queue.mean_depth, queue.spilled_total)
+            else:
+                depth = (0, 0.0, 0)
+            print(u"%-12s %10d %10.2f %12.1f %10d %10.1f %10d" % (
+                (stats.name, stats.items, stats.elapsed, stats.throughput) + depth))
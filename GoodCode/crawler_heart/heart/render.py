@@ -0,0 +1,116 @@
+# -*- coding:utf-8 -*-
+"""
+词云渲染服务：蒙版图片和字体路径只加载一次并常驻内存，直接把 WordCloud 的结果保存为 PNG/JPEG，
+不经过 matplotlib；批量渲染时在进程池中并行，每个进程各自加载一次蒙版
+"""
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+from wordcloud import WordCloud
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir))
+from crawler_common.processes import pool_context  # noqa: E402
+
+FONT_DIRS = (
+    "C:/Windows/Fonts",
+    "/Library/Fonts",
+    os.path.expanduser("~/Library/Fonts"),
+    "/usr/share/fonts",
+    "/usr/local/share/fonts",
+    os.path.expanduser("~/.fonts"),
+)
+
+
+def resolve_font(font):
+    """
+    :param font: 字体文件路径或文件名，例如 msyh.ttc
+    :return: 字体文件的完整路径，找不到时原样返回，交给 WordCloud 报错
+    """
+    if os.path.exists(font):
+        return os.path.abspath(font)
+    for directory in FONT_DIRS:
+        for root, _, files in os.walk(directory):
+            if font in files:
+                return os.path.join(root, font)
+    return font
+
+
+class CloudRenderer(object):
+    """
+    用法：
+        renderer = CloudRenderer()
+        renderer.render(frequency.top(200), "./heart.jpg")
+    """
+
+    def __init__(self, font='msyh.ttc', background_color='white', max_words=200, scale=1):
+        """
+        :param font: 字体文件路径或文件名，中文词云需要中文字体
+        :param background_color: 背景色
+        :param max_words: 默认最多显示的词数，render 可以单独指定
+        :param scale: 输出图片相对蒙版尺寸的放大倍数
+        """
+        self.font_path = resolve_font(font)
+        self.background_color = background_color
+        self.max_words = max_words
+        self.scale = scale
+        self._masks = {}
+
+    def mask(self, path):
+        """
+        :return: 灰度蒙版数组，同一个文件只读取一次
+        """
+        mask = self._masks.get(path)
+        if mask is None:
+            mask = self._masks[path] = np.array(Image.open(path).convert("L"))
+        return mask
+
+    def render(self, frequencies, output, mask_path='./heart-mask.jpg', max_words=None):
+        """
+        :param frequencies: 词 -> 次数
+        :param output: 输出图片路径，格式由扩展名决定
+        :param mask_path: 蒙版图片路径
+        :param max_words: 最多显示的词数，默认为创建时指定的 max_words
+        :return: output
+        """
+        wordcloud = WordCloud(
+            font_path=self.font_path,
+            background_color=self.background_color,
+            mask=self.mask(mask_path),
+            max_words=max_words or self.max_words,
+            scale=self.scale
+        ).generate_from_frequencies(frequencies)
+        image = wordcloud.to_image()
+        if os.path.splitext(output)[1].lower() in (".jpg", ".jpeg"):
+            image = image.convert("RGB")
+        image.save(output)
+        return output
+
+
+_worker_renderer = None
+
+
+def _init_render_worker(options):
+    global _worker_renderer
+    _worker_renderer = CloudRenderer(**options)
+
+
+def _render_job(job):
+    return _worker_renderer.render(*job)
+
+
+def render_many(jobs, processes=None, **options):
+    """
+    在进程池中批量渲染词云，例如按用户或按天各生成一张
+    :param jobs: (frequencies, output)、(frequencies, output, mask_path)
+                 或 (frequencies, output, mask_path, max_words) 的可迭代对象
+    :param processes: 进程数，默认为 CPU 核数
+    :param options: 传给 CloudRenderer 的参数
+    :return: 输出图片路径列表，顺序与 jobs 一致
+    """
+    # 可能在流水线的线程里调用，不能直接 fork
+    with ProcessPoolExecutor(max_workers=processes, mp_context=pool_context(),
+                             initializer=_init_render_worker, initargs=(options,)) as executor:
+        return list(executor.map(_render_job, jobs))
@@ -0,0 +1,109 @@
+# coding=utf-8
+"""
+抓取吞吐量压测：在本地启动模拟教程站点，端到端运行 LiaoxuefengPythonCrawler，
+输出页面吞吐量、抓取延迟 p50/p99、解析 CPU 时间和内存峰值
+
+用法：
+    python bench_crawl.py --pages 300 --latency 0.05 --error-rate 0.01 --concurrency 8
+    python bench_crawl.py --pdf        # 同时渲染 PDF，需要安装 wkhtmltopdf
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from crawler import PARSERS, LiaoxuefengPythonCrawler, peak_rss_mb
+from fakesite import FakeSite
+
+
+class NullAssembler(object):
+    """
+    只消费章节不渲染 PDF 的 PdfAssembler，用于单独测量抓取和解析
+    """
+
+    def __init__(self, output, options=None, transform=None):
+        self.transform = transform
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def add(self, html):
+        if self.transform is not None:
+            self.transform(html)
+        self.count += 1
+
+    def finish(self):
+        pass
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=u"在本地模拟站点上压测 LiaoxuefengPythonCrawler")
+    parser.add_argument("--pages", type=int, default=200, help=u"章节数")
+    parser.add_argument("--paragraphs", type=int, default=40, help=u"每章段落数")
+    parser.add_argument("--images", type=int, default=3, help=u"每章图片数")
+    parser.add_argument("--latency", type=float, default=0.02, help=u"每个请求的延迟（秒）")
+    parser.add_argument("--jitter", type=float, default=0.01, help=u"随机延迟上限（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help=u"返回 503 的概率")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--host-concurrency", type=int, default=8)
+    parser.add_argument("--parse-workers", type=int, default=0)
+    parser.add_argument("--parser", choices=PARSERS, default="html.parser")
+    parser.add_argument("--embed-images", action="store_true", help=u"预取并嵌入图片")
+    parser.add_argument("--cache", action="store_true", help=u"启用 HTTP 缓存，运行两遍以测量缓存命中时的速度")
+    parser.add_argument("--pdf", action="store_true", help=u"渲染 PDF，需要安装 wkhtmltopdf")
+    args = parser.parse_args()
+
+    site = FakeSite(pages=args.pages, paragraphs=args.paragraphs, images=args.images,
+                    latency=args.latency, jitter=args.jitter, error_rate=args.error_rate).start()
+    work_dir = tempfile.mkdtemp(prefix="bench-crawl-")
+    try:
+        rounds = 2 if args.cache else 1
+        for round_no in range(rounds):
+            crawler = LiaoxuefengPythonCrawler(
+                os.path.join(work_dir, "book"), site.url,
+                concurrency=args.concurrency, host_concurrency=args.host_concurrency,
+                parse_workers=args.parse_workers, parser=args.parser, retry_delay=0.01,
+                cache_dir=os.path.join(work_dir, "httpcache") if args.cache else None,
+                image_dir=os.path.join(work_dir, "images") if args.embed_images else None)
+            if not args.pdf:
+                crawler.assembler_class = NullAssembler
+            requests_before = site.requests
+            start = time.time()
+            crawler.run()
+            elapsed = time.time() - start
+
+            latencies = [seconds for _, seconds in crawler.fetch_timings]
+            parse_cpu = sum(cpu for _, _, cpu in crawler.parse_timings)
+            rss = peak_rss_mb()
+            print(u"")
+            print(u"==== 第 %d 轮 ====" % (round_no + 1))
+            print(u"页面数：        %d" % len(crawler.parse_timings))
+            print(u"吞吐量：        %.2f 页/秒（总耗时 %.2f 秒）" % (len(crawler.parse_timings) / elapsed, elapsed))
+            print(u"抓取延迟：      p50 %.1f 毫秒，p99 %.1f 毫秒（%d 次请求，站点计数 %d，503 共 %d 次）" % (
+                percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+                len(latencies), site.requests - requests_before, site.errors))
+            print(u"解析 CPU 时间： %.3f 秒，平均 %.2f 毫秒/页" % (
+                parse_cpu, parse_cpu * 1000 / max(1, len(crawler.parse_timings))))
+            if args.parse_workers:
+                print(u"内存峰值：      %.1f MB（解析进程 %.1f MB）" % (rss, crawler.parse_peak_rss_mb))
+            else:
+                print(u"内存峰值：      %.1f MB" % rss)
+    finally:
+        site.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
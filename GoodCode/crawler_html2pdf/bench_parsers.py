@@ -0,0 +1,109 @@
+# coding=utf-8
+"""
+在保存到本地的教程页面上比较各个解析后端的速度，并检查输出是否与 html.parser 一致
+
+用法：
+    python bench_parsers.py --save <start_url> pages     # 先把目录页和章节页保存到 pages 目录
+    python bench_parsers.py pages                        # 对保存的页面做基准测试
+    python bench_parsers.py --fake 50 pages              # 先保存本地模拟站点的页面，不访问真实站点
+"""
+import argparse
+import glob
+import os
+import time
+
+from bs4 import FeatureNotFound
+
+from crawler import PARSERS, LiaoxuefengPythonCrawler, Page
+from fakesite import FakeSite
+
+MENU_FILE = "menu.html"
+
+
+def save_pages(start_url, directory, limit):
+    """
+    抓取目录页和前 limit 个章节页，保存到 directory
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    crawler = LiaoxuefengPythonCrawler("bench", start_url)
+    menu = crawler.fetch(start_url)
+    with open(os.path.join(directory, MENU_FILE), "wb") as f:
+        f.write(menu.content)
+    urls = list(crawler.parse_menu(menu))[:limit]
+    for index, (url, response) in enumerate(crawler.crawl_all(urls)):
+        with open(os.path.join(directory, "%04d.html" % index), "wb") as f:
+            f.write(response.content)
+
+
+def load_pages(directory):
+    """
+    :return: (目录页 Page 或 None, 章节页 Page 列表)
+    """
+    menu = None
+    pages = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.html"))):
+        with open(path, "rb") as f:
+            page = Page(path, f.read())
+        if os.path.basename(path) == MENU_FILE:
+            menu = page
+        else:
+            pages.append(page)
+    return menu, pages
+
+
+def bench(parser, start_url, menu, pages, rounds):
+    """
+    :return: (每页平均耗时秒数, 目录解析结果, 正文解析结果)
+    """
+    crawler = LiaoxuefengPythonCrawler("bench", start_url, parser=parser)
+    urls = list(crawler.parse_menu(menu)) if menu is not None else []
+    start = time.time()
+    for _ in range(rounds):
+        htmls = [crawler.parse_body(page) for page in pages]
+    elapsed = time.time() - start
+    return elapsed / (rounds * len(pages)), urls, htmls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=u"比较 Crawler 解析后端的速度")
+    parser.add_argument("directory", help=u"保存页面的目录")
+    parser.add_argument("--save", metavar="START_URL", help=u"先抓取教程并保存到 directory")
+    parser.add_argument("--fake", type=int, metavar="PAGES", help=u"先启动 PAGES 章的模拟站点并保存到 directory")
+    parser.add_argument("--limit", type=int, default=50, help=u"保存的章节数")
+    parser.add_argument("--rounds", type=int, default=3, help=u"每个后端重复解析的轮数")
+    parser.add_argument("--start-url", default="https://www.liaoxuefeng.com/",
+                        help=u"用于补全图片地址的入口 URL")
+    args = parser.parse_args()
+
+    if args.save:
+        save_pages(args.save, args.directory, args.limit)
+    elif args.fake:
+        site = FakeSite(pages=args.fake)
+        site.start()
+        try:
+            save_pages(site.url, args.directory, args.fake)
+        finally:
+            site.stop()
+        args.start_url = site.url
+    menu, pages = load_pages(args.directory)
+    if not pages:
+        parser.error(u"%s 中没有保存的页面" % args.directory)
+
+    baseline = None
+    print(u"%-12s %12s %8s  %s" % (u"后端", u"毫秒/页", u"加速比", u"输出与 html.parser 一致"))
+    for backend in PARSERS:
+        try:
+            per_page, urls, htmls = bench(backend, args.start_url, menu, pages, args.rounds)
+        except FeatureNotFound:
+            print(u"%-12s 未安装" % backend)
+            continue
+        if baseline is None:
+            baseline = (per_page, urls, htmls)
+        differ = sum(1 for a, b in zip(baseline[2], htmls) if a != b)
+        same = u"是" if differ == 0 and urls == baseline[1] else u"否（%d 页不同）" % differ
+        print(u"%-12s %12.2f %7.2fx  %s" % (backend, per_page * 1000, baseline[0] / per_page, same))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# coding=utf-8
+"""
+断点续爬：记录每个已完成章节的 url 和解析结果的哈希，重新运行时跳过已完成的章节
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+
+class CheckpointJournal(object):
+    """
+    目录结构：
+        <directory>/journal.jsonl   每行一条 {"url": ..., "sha1": ...}，只追加
+        <directory>/<sha1>.html     章节解析后的 html
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.journal_path = os.path.join(directory, "journal.jsonl")
+        self._done = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if os.path.exists(self.journal_path):
+            self._replay()
+        self._journal = open(self.journal_path, "a")
+
+    def _fragment_path(self, digest):
+        return os.path.join(self.directory, digest + ".html")
+
+    def _replay(self):
+        with open(self.journal_path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 上次运行中断时最后一行可能没有写完整
+                    continue
+                self._done[record["url"]] = record["sha1"]
+        # 丢弃内容丢失或与哈希不一致的章节，重新抓取
+        for url, digest in list(self._done.items()):
+            try:
+                with open(self._fragment_path(digest), "rb") as f:
+                    valid = hashlib.sha1(f.read()).hexdigest() == digest
+            except IOError:
+                valid = False
+            if not valid:
+                logging.warning(u"章节 %s 的断点已损坏，重新抓取", url)
+                del self._done[url]
+
+    def __contains__(self, url):
+        return url in self._done
+
+    def __len__(self):
+        return len(self._done)
+
+    def load(self, url):
+        """
+        :return: 已完成章节的 html 字节
+        """
+        with open(self._fragment_path(self._done[url]), "rb") as f:
+            return f.read()
+
+    def record(self, url, html):
+        """
+        保存章节的解析结果并写入日志，写入完成后才算该章节已完成
+        """
+        digest = hashlib.sha1(html).hexdigest()
+        path = self._fragment_path(digest)
+        if not os.path.exists(path):
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, "wb") as f:
+                f.write(html)
+            os.replace(tmp_path, path)
+        self._journal.write(json.dumps({"url": url, "sha1": digest}) + "\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._done[url] = digest
+
+    def close(self):
+        self._journal.close()
+
+    def clear(self):
+        """
+        整本书生成成功后删除断点目录
+        """
+        self.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -3,16 +3,43 @@
 import logging
 import os
 import re
+import sys
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 try:
     from urllib.parse import urlparse   # py3
 except:
     from urlparse import urlparse
 
-import pdfkit
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, FeatureNotFound, SoupStrainer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from checkpoint import CheckpointJournal  # noqa: E402
+from crawler_common.frontier import Frontier  # noqa: E402
+from crawler_common.metrics import Metrics  # noqa: E402
+from crawler_common.processes import pool_context  # noqa: E402
+from crawler_common.ratelimit import PolitenessScheduler  # noqa: E402
+from crawler_common.session import get_session  # noqa: E402
+from httpcache import HttpCache  # noqa: E402
+from images import ImageStore  # noqa: E402
+from pdfpipeline import PdfAssembler  # noqa: E402
+
+# parser 可选的解析后端："strainer" 只为 parse_only 指定的标签构建节点，不构建整棵树
+PARSERS = ("html.parser", "lxml", "html5lib", "strainer")
+
+try:
+    import lxml  # noqa: F401
+    STRAINER_PARSER = "lxml"
+except ImportError:
+    STRAINER_PARSER = "html.parser"
 
 html_template = """
 <!DOCTYPE html>
@@ -27,21 +54,125 @@ html_template = """
 """
 
 
+def ordered_results(submit, items, window):
+    """
+    并发执行任务，按输入顺序逐个返回结果
+    :param submit: 提交任务的函数，接收一个 item，返回 Future
+    :param items: 任务参数的可迭代对象
+    :param window: 最多同时保留的未完成任务数，避免结果堆积在内存中
+    :return: (item, result) 生成器
+    """
+    pending = deque()
+    try:
+        for item in items:
+            pending.append((item, submit(item)))
+            if len(pending) >= window:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+
+class Page(object):
+    """
+    只包含 url 和原始字节的 response 对象，用于在解析进程中调用 parse_body
+    """
+    __slots__ = ("url", "content")
+
+    def __init__(self, url, content):
+        self.url = url
+        self.content = content
+
+
+_worker_crawler = None
+
+
+def _init_parse_worker(crawler_class, name, start_url, parser):
+    global _worker_crawler
+    _worker_crawler = crawler_class(name, start_url, concurrency=1, parser=parser)
+
+
+def peak_rss_mb():
+    """
+    :return: 当前进程的内存峰值，单位 MB，不支持时返回 0
+    """
+    if resource is None:
+        return 0.0
+    # Linux 上 ru_maxrss 的单位是 KB，macOS 上是字节
+    scale = 1024.0 * 1024 if sys.platform == "darwin" else 1024.0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def _parse_in_worker(url, content):
+    """
+    在解析进程中执行 parse_body，进程之间只传递原始字节和解析后的 html 字节
+    :return: (html, 耗时秒数, CPU 时间秒数, 解析进程的内存峰值 MB)
+    """
+    start, cpu_start = time.time(), time.thread_time()
+    html = _worker_crawler.parse_body(Page(url, content))
+    return html, time.time() - start, time.thread_time() - cpu_start, peak_rss_mb()
+
+
 class Crawler(object):
     """
     爬虫基类，所有爬虫都应该继承此类
     """
     name = None
+    assembler_class = PdfAssembler
 
-    def __init__(self, name, start_url):
+    def __init__(self, name, start_url, concurrency=8, host_concurrency=4, host_delay=0.0, scheduler=None, session=None,
+                 cache_dir=None, cache_max_bytes=512 * 1024 * 1024, parse_workers=0, parser="html.parser",
+                 checkpoint_dir=None, retries=2, retry_delay=1.0,
+                 image_dir=None, image_mode="data", image_max_width=None, metrics=None):
         """
         初始化
         :param name: 保存文件的PDF文件名，不需要后缀名
         :param start_url: 爬虫入口URL
+        :param concurrency: 同时抓取的最大页面数，1 表示逐个抓取
+        :param host_concurrency: 同一主机同时抓取的最大页面数
+        :param host_delay: 同一主机相邻两次请求之间的最小间隔（秒），robots.txt 的 Crawl-delay 更大时以后者为准
+        :param scheduler: 共享的 PolitenessScheduler，多个爬虫同时运行时共用同一份域名限速；
+            指定后忽略 host_concurrency 和 host_delay
+        :param session: 共享的 PooledSession，默认使用进程内的共享会话
+        :param cache_dir: HTTP 缓存目录，为 None 时不缓存
+        :param cache_max_bytes: HTTP 缓存的最大字节数
+        :param parse_workers: 解析进程数，0 表示在主线程中解析
+        :param parser: BeautifulSoup 解析后端，取值见 PARSERS
+        :param checkpoint_dir: 断点目录，为 None 时不记录断点；中断后重新运行会跳过已完成的章节
+        :param retries: 每个章节抓取或解析失败后的重试次数
+        :param retry_delay: 第一次重试前等待的秒数，之后每次翻倍
+        :param image_dir: 图片缓存目录，设置后渲染前预先下载图片并嵌入 html，渲染时不再访问网络
+        :param image_mode: 图片嵌入方式，"data" 为 data URI，"file" 为本地文件路径
+        :param image_max_width: 图片最大宽度（像素），超过时等比缩小，需要安装 Pillow
+        :param metrics: 记录抓取和解析指标的 Metrics，需要追踪文件或 Prometheus 输出时传入
         """
+        if parser not in PARSERS:
+            raise ValueError("parser must be one of %s, got %r" % (", ".join(PARSERS), parser))
         self.name = name
         self.start_url = start_url
         self.domain = '{uri.scheme}://{uri.netloc}'.format(uri=urlparse(self.start_url))
+        self.concurrency = max(1, concurrency)
+        self.session = session or get_session()
+        self.scheduler = scheduler or PolitenessScheduler(host_delay, concurrency=host_concurrency,
+                                                          session=self.session)
+        self.cache = HttpCache(cache_dir, cache_max_bytes) if cache_dir else None
+        self.parse_workers = parse_workers
+        self.fetch_timings = []     # [(url, 每次请求的耗时秒数)]，重试的每次请求单独记录
+        self.parse_timings = []     # [(url, 解析耗时秒数, 解析 CPU 时间秒数)]
+        # 解析进程由 forkserver 启动，不是本进程的子进程，RUSAGE_CHILDREN 统计不到，由解析进程自己上报
+        self.parse_peak_rss_mb = 0.0
+        self.parser = parser
+        self.checkpoint_dir = checkpoint_dir
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.image_dir = image_dir
+        self.image_mode = image_mode
+        self.image_max_width = image_max_width
+        self.metrics = metrics or Metrics("html2pdf")
 
     def crawl(self, url):
         """
@@ -49,10 +180,108 @@ class Crawler(object):
         :param url:
         :return:
         """
-        print(url)
-        response = requests.get(url)
+        logging.debug(u"抓取 %s", url)
+        if self.cache is not None:
+            # 条件请求，页面没有变化时直接使用缓存的正文
+            return self.cache.fetch(self.session, url)
+        response = self.session.get(url)
         return response
 
+    def fetch(self, url):
+        """
+        遵守主机限速规则抓取 url，网络错误或者返回 5xx/429 时按指数退避重试
+        :param url:
+        :return: crawl 返回的 response 对象
+        """
+        for attempt in range(self.retries + 1):
+            start = time.time()
+            try:
+                with self.scheduler.hold(url):
+                    start = time.time()
+                    try:
+                        response = self.crawl(url)
+                    finally:
+                        elapsed = time.time() - start
+                        self.fetch_timings.append((url, elapsed))
+            except requests.RequestException as e:
+                self.metrics.record_fetch(url, None, time.time() - start, error=e)
+                if attempt == self.retries:
+                    raise
+                logging.warning(u"抓取失败，准备重试：%s", url, exc_info=True)
+            else:
+                status = getattr(response, "status_code", 200)
+                self.metrics.record_fetch(url, status, elapsed, len(getattr(response, "content", None) or b""),
+                                          cached=getattr(response, "from_cache", False))
+                if (status < 500 and status != 429) or attempt == self.retries:
+                    return response
+                logging.warning(u"抓取 %s 返回 %d，准备重试", url, status)
+            time.sleep(self.retry_delay * 2 ** attempt)
+
+    def recover(self, url):
+        """
+        parse_body 没有返回结果时，重新抓取并解析该章节
+        :return: 处理后的 html 文本
+        """
+        for attempt in range(self.retries):
+            time.sleep(self.retry_delay * 2 ** attempt)
+            html = self.parse_body(self.fetch(url))
+            if html is not None:
+                return html
+        raise RuntimeError(u"章节解析失败：%s" % url)
+
+    def crawl_all(self, urls):
+        """
+        并发抓取 urls，最多同时抓取 concurrency 个页面
+        :param urls: url 可迭代对象
+        :return: (url, response) 生成器，顺序与 urls 一致
+        """
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            def submit(url):
+                return executor.submit(self.fetch, url)
+            for url, response in ordered_results(submit, urls, self.concurrency * 2):
+                yield url, response
+
+    def parse_all(self, pages):
+        """
+        解析正文，parse_workers 大于 0 时在进程池中并行解析
+        :param pages: (url, response) 可迭代对象
+        :return: (url, html) 生成器，顺序与 pages 一致，每页耗时记录在 parse_timings 中
+        """
+        if not self.parse_workers:
+            for url, response in pages:
+                start, cpu_start = time.time(), time.thread_time()
+                html = self.parse_body(response)
+                seconds, cpu_seconds = time.time() - start, time.thread_time() - cpu_start
+                self.parse_timings.append((url, seconds, cpu_seconds))
+                self.metrics.record_parse(url, seconds, cpu_seconds)
+                yield url, html
+            return
+
+        # 抓取线程已在运行，不能直接 fork
+        with ProcessPoolExecutor(max_workers=self.parse_workers, mp_context=pool_context(),
+                                 initializer=_init_parse_worker,
+                                 initargs=(type(self), self.name, self.start_url, self.parser)) as executor:
+            def submit(page):
+                url, response = page
+                return executor.submit(_parse_in_worker, url, response.content)
+            for (url, _), (html, seconds, cpu_seconds, rss) in ordered_results(submit, pages,
+                                                                                self.parse_workers * 2):
+                self.parse_timings.append((url, seconds, cpu_seconds))
+                self.parse_peak_rss_mb = max(self.parse_peak_rss_mb, rss)
+                self.metrics.record_parse(url, seconds, cpu_seconds)
+                yield url, html
+
+    def make_soup(self, content, only=None):
+        """
+        按 parser 设置构建 BeautifulSoup 对象
+        :param content: html 字节
+        :param only: SoupStrainer，parser 为 "strainer" 时只为匹配的标签构建节点，其他后端忽略
+        :return: BeautifulSoup 对象
+        """
+        if self.parser == "strainer":
+            return BeautifulSoup(content, STRAINER_PARSER, parse_only=only)
+        return BeautifulSoup(content, self.parser)
+
     def parse_menu(self, reponse):
         """
         解析目录结构，获取所有URL目录列表：由子类实现
@@ -61,6 +290,16 @@ class Crawler(object):
         """
         raise NotImplementedError
 
+    def menu_urls(self):
+        """
+        抓取并解析目录，规范化后去掉重复的 URL
+        :return: url 列表，顺序与目录一致
+        """
+        with Frontier() as frontier:
+            for url in self.parse_menu(self.fetch(self.start_url)):
+                frontier.add(url)
+            return list(frontier.drain())
+
     def parse_body(self, response):
         """
         解析正文，由子类实现
@@ -87,18 +326,95 @@ class Crawler(object):
             ],
             'outline-depth': 10,
         }
-        htmls = []
-        for index, url in enumerate(self.parse_menu(self.crawl(self.start_url))):
-            html = self.parse_body(self.crawl(url))
-            f_name = ".".join([str(index), "html"])
-            with open(f_name, 'wb') as f:
-                f.write(html)
-            htmls.append(f_name)
-        pdfkit.from_file(htmls, self.name + ".pdf", options=options)
-        for html in htmls:
-            os.remove(html)
+        journal = CheckpointJournal(self.checkpoint_dir) if self.checkpoint_dir else None
+        images = None
+        if self.image_dir:
+            images = ImageStore(self.image_dir, self.fetch, workers=self.concurrency,
+                                mode=self.image_mode, max_width=self.image_max_width)
+            if self.image_mode == "file":
+                options['enable-local-file-access'] = None
+        try:
+            # 章节解析完成后立即在后台渲染，与后续章节的抓取重叠进行；
+            # 图片在解析后立即开始下载，渲染线程在渲染前把图片嵌入 html
+            with self.assembler_class(self.name + ".pdf", options=options,
+                                      transform=images.embed if images is not None else None) as assembler:
+                parsed = None
+                try:
+                    urls = self.menu_urls()
+                    resumed = set(url for url in urls if journal is not None and url in journal)
+                    if resumed:
+                        print(u"从断点继续：跳过 %d 个已完成的章节" % len(resumed))
+                    parsed = self.parse_all(self.crawl_all(url for url in urls if url not in resumed))
+                    for url in urls:
+                        if url in resumed:
+                            html = journal.load(url)
+                        else:
+                            _, html = next(parsed)
+                            if html is None:
+                                html = self.recover(url)
+                            if journal is not None:
+                                journal.record(url, html)
+                        if images is not None:
+                            images.prefetch(html)
+                        assembler.add(html)
+                finally:
+                    if parsed is not None:
+                        parsed.close()
+                    if self.cache is not None:
+                        self.cache.save()
+                    if journal is not None:
+                        journal.close()
+                assembler.finish()
+        finally:
+            if images is not None:
+                images.close()
+            # 写出 Prometheus 文本并关闭追踪文件，中途出错时也保留已有的指标
+            self.metrics.close()
+        if journal is not None:
+            journal.clear()
         total_time = time.time() - start
-        print(u"总共耗时：%f 秒" % total_time)
+        print(u"总共耗时：%f 秒，共 %d 页，%.2f 页/秒" % (total_time, assembler.count, assembler.count / total_time))
+        print(self.metrics.summary())
+        stats = self.session.stats()
+        print(u"连接复用率：%.1f%%，传输 %d 字节（解压后 %d 字节）" % (
+            stats["reuse_ratio"] * 100, stats["bytes_received"], stats["bytes_decoded"]))
+        if self.cache is not None:
+            print(u"缓存命中：%d 页，重新下载：%d 页，出错：%d 次" % (
+                self.cache.hits, self.cache.misses, self.cache.errors))
+
+
+def _is_title_or_body(name, attrs):
+    """
+    任意 h4 标题，以及 class 含 "x-wiki-content" 的正文 div
+    """
+    if name == "h4":
+        return True
+    if name != "div":
+        return False
+    classes = (attrs or {}).get("class") or ""
+    if not isinstance(classes, str):
+        classes = " ".join(classes)
+    return "x-wiki-content" in classes.split()
+
+
+class TitleBodyStrainer(SoupStrainer):
+    """
+    只为标题和正文构建节点的 SoupStrainer。名字和 class 的条件要组合起来判断，
+    普通 SoupStrainer 的参数表达不了：bs4 4.13 起解析时调用 allow_tag_creation，
+    更早的版本用 (标签名, 属性) 调用 name 指定的函数
+    """
+
+    def __init__(self):
+        super(TitleBodyStrainer, self).__init__(self._match)
+
+    @staticmethod
+    def _match(name, attrs=None):
+        if attrs is None and hasattr(name, "attrs"):    # 解析完成后按 Tag 匹配
+            name, attrs = name.name, name.attrs
+        return _is_title_or_body(name, attrs)
+
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        return _is_title_or_body(name, attrs)
 
 
 class LiaoxuefengPythonCrawler(Crawler):
@@ -111,7 +427,7 @@ class LiaoxuefengPythonCrawler(Crawler):
         :param response: 爬虫返回的 response 对象
         :return: url 生成器
         """
-        soup = BeautifulSoup(response.content, "html.parser")
+        soup = self.make_soup(response.content, only=SoupStrainer(class_="uk-nav uk-nav-side"))
         menu_tag = soup.find_all(class_="uk-nav uk-nav-side")[1]
         for li in menu_tag.find_all("li"):
             url = li.a.get("href")
@@ -126,7 +442,8 @@ class LiaoxuefengPythonCrawler(Crawler):
         :return: 返回处理后的 html 文本
         """
         try:
-            soup = BeautifulSoup(response.content, "html.parser")
+            # 一次解析同时取出标题和正文
+            soup = self.make_soup(response.content, only=TitleBodyStrainer())
             body = soup.find_all(class_="x-wiki-content")[0]
 
             # 加入标题，居中显示
@@ -152,6 +469,9 @@ class LiaoxuefengPythonCrawler(Crawler):
             html = html_template.format(content=html)
             html = html.encode("utf-8")
             return html
+        except FeatureNotFound:
+            # 解析后端未安装不是页面的问题，交给调用方处理
+            raise
         except Exception as e:
             logging.error("解析错误", exc_info=True)
 
@@ -159,5 +479,9 @@ class LiaoxuefengPythonCrawler(Crawler):
 
 if __name__ == '__main__':
     start_url = "http://www.liaoxuefeng.com/wiki/0014316089557264a6b348958f449949df42a6d3a2e542c000"
-    crawler = LiaoxuefengPythonCrawler("廖雪峰Git", start_url)
+    crawler = LiaoxuefengPythonCrawler("廖雪峰Git", start_url, cache_dir=".httpcache",
+                                       parse_workers=os.cpu_count(), checkpoint_dir="廖雪峰Git.checkpoint",
+                                       image_dir=".imagecache",
+                                       metrics=Metrics("html2pdf", trace_path="廖雪峰Git.trace.jsonl",
+                                                       prometheus_path="廖雪峰Git.prom"))
     crawler.run()
\ No newline at end of file
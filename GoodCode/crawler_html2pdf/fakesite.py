@@ -0,0 +1,196 @@
+# coding=utf-8
+"""
+本地的模拟教程站点，页面结构与廖雪峰教程一致，用于在不访问真实站点的情况下测试和压测爬虫
+
+    /                   目录页，第二个 "uk-nav uk-nav-side" 中列出所有章节
+    /wiki/<n>           章节页，包含 h4 标题和 "x-wiki-content" 正文；
+                        奇数章的标题带 class，正文外面还套了一层没有 class 的 div
+    /static/img/<k>.png 章节中引用的图片，多个章节共用
+
+可以配置每个请求的延迟和出错率（返回 503），页面带 ETag，支持条件请求
+"""
+import hashlib
+import random
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+# 1x1 像素的 PNG 图片
+PNG = (b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f\x15\xc4"
+       b"\x89\x00\x00\x00\rIDATx\x9cc\xf8\x0f\x00\x00\x01\x01\x00\x05\x18\xd8N\x00\x00\x00\x00IEND\xaeB`\x82")
+
+MENU_TEMPLATE = u"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Fake Tutorial</title></head>
+<body>
+<ul class="uk-nav uk-nav-side"><li><a href="/">首页</a></li></ul>
+<ul class="uk-nav uk-nav-side">
+{items}
+</ul>
+</body></html>"""
+
+CHAPTER_TEMPLATE = u"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>第 {n} 章</title></head>
+<body>
+<ul class="uk-nav uk-nav-side"><li><a href="/">首页</a></li></ul>
+<h4>第 {n} 章</h4>
+<div class="x-wiki-content">
+{paragraphs}
+</div>
+<div class="x-footer">{footer}</div>
+</body></html>"""
+
+WRAPPED_CHAPTER_TEMPLATE = u"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>第 {n} 章</title></head>
+<body>
+<ul class="uk-nav uk-nav-side"><li><a href="/">首页</a></li></ul>
+<h4 class="x-title">第 {n} 章</h4>
+<div>
+<div class="x-wiki-content">
+{paragraphs}
+</div>
+<div class="x-footer">{footer}</div>
+</div>
+</body></html>"""
+
+
+class FakeSite(object):
+    """
+    用法：
+        site = FakeSite(pages=300, latency=0.05, error_rate=0.01)
+        site.start()
+        ... site.url ...
+        site.stop()
+    """
+
+    def __init__(self, pages=100, paragraphs=40, images=3, image_pool=20,
+                 latency=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        """
+        :param pages: 章节数
+        :param paragraphs: 每章的段落数，控制页面大小
+        :param images: 每章引用的图片数
+        :param image_pool: 不同图片的总数，章节之间共用
+        :param latency: 每个请求的固定延迟（秒）
+        :param jitter: 在固定延迟之上增加的随机延迟上限（秒）
+        :param error_rate: 返回 503 的概率
+        :param seed: 随机数种子，保证多次压测的结果可比较
+        """
+        self.pages = pages
+        self.paragraphs = paragraphs
+        self.images = images
+        self.image_pool = image_pool
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/" % self._server.server_address[1]
+
+    def menu(self):
+        items = u"\n".join(u'<li><a href="/wiki/%d">第 %d 章</a></li>' % (n, n) for n in range(self.pages))
+        return MENU_TEMPLATE.format(items=items)
+
+    def chapter(self, n):
+        paragraphs = []
+        for i in range(self.paragraphs):
+            paragraphs.append(u"<p>第 %d 章第 %d 段，<b>加粗</b>和<code>代码</code>混排的正文。</p>" % (n, i))
+            if i < self.images:
+                paragraphs.append(u'<p><img src="/static/img/%d.png" alt=""></p>' % ((n + i) % self.image_pool))
+        footer = u"<span>页脚</span>" * self.paragraphs
+        template = WRAPPED_CHAPTER_TEMPLATE if n % 2 else CHAPTER_TEMPLATE
+        return template.format(n=n, paragraphs=u"\n".join(paragraphs), footer=footer)
+
+    def resolve(self, path):
+        """
+        :return: (状态码, Content-Type, 正文)
+        """
+        if path == "/":
+            return 200, "text/html; charset=utf-8", self.menu().encode("utf-8")
+        if path.startswith("/wiki/"):
+            try:
+                n = int(path[len("/wiki/"):])
+            except ValueError:
+                n = -1
+            if 0 <= n < self.pages:
+                return 200, "text/html; charset=utf-8", self.chapter(n).encode("utf-8")
+        if path.startswith("/static/img/") and path.endswith(".png"):
+            return 200, "image/png", PNG
+        return 404, "text/plain", b"not found"
+
+    def _handler(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with site._lock:
+                    site.requests += 1
+                    delay = site.latency + site._random.random() * site.jitter
+                    failed = site._random.random() < site.error_rate
+                    if failed:
+                        site.errors += 1
+                if delay:
+                    time.sleep(delay)
+                if failed:
+                    self.send_response(503)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                status, content_type, body = site.resolve(self.path)
+                etag = '"%s"' % hashlib.sha1(body).hexdigest()
+                if status == 200 and self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        Handler.protocol_version = "HTTP/1.1"
+        return Handler
+
+    def start(self, port=0):
+        server_class = type("ThreadingHTTPServer", (ThreadingMixIn, HTTPServer), {"daemon_threads": True})
+        self._server = server_class(("127.0.0.1", port), self._handler())
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=u"启动本地模拟教程站点")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--pages", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    site = FakeSite(pages=args.pages, latency=args.latency, error_rate=args.error_rate).start(args.port)
+    print(u"模拟站点：%s" % site.url)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        site.stop()
@@ -0,0 +1,232 @@
+# coding=utf-8
+"""
+持久化的 HTTP 响应缓存：正文按内容哈希存储，借助 ETag/Last-Modified 做条件请求，
+服务器返回 304 时直接使用缓存的正文，缓存总大小超过上限时按 LRU 淘汰
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+# 需要随正文一起缓存的响应头
+CACHED_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+
+
+class HttpCache(object):
+    """
+    目录结构：
+        <directory>/index.json        url -> 元数据（正文哈希、大小、校验头、最后访问时间）
+        <directory>/objects/ab/abcd…  按 sha1 存放的正文
+    """
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024):
+        """
+        :param directory: 缓存目录，不存在时自动创建
+        :param max_bytes: 正文总大小上限（字节），超过后淘汰最久未访问的条目
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, "index.json")
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0     # 出错的响应（4xx/5xx）不算未命中，单独计数
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._entries = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                self._entries = json.load(f)
+
+    def _object_path(self, digest):
+        return os.path.join(self.directory, "objects", digest[:2], digest)
+
+    def conditional_headers(self, url):
+        """
+        :return: 用于重新验证 url 缓存的请求头，没有缓存时返回空字典
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+        if entry is None:
+            return {}
+        headers = {}
+        if entry["headers"].get("ETag"):
+            headers["If-None-Match"] = entry["headers"]["ETag"]
+        if entry["headers"].get("Last-Modified"):
+            headers["If-Modified-Since"] = entry["headers"]["Last-Modified"]
+        return headers
+
+    def load(self, url):
+        """
+        从缓存构造一个 requests 的 Response 对象
+        :return: Response，缓存不存在或正文丢失时返回 None
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                return None
+            entry["atime"] = time.time()
+            self._dirty = True
+        try:
+            with open(self._object_path(entry["digest"]), "rb") as f:
+                content = f.read()
+        except IOError:
+            with self._lock:
+                self._entries.pop(url, None)
+            return None
+        response = Response()
+        response.status_code = 200
+        response.url = url
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.encoding = entry.get("encoding")
+        response._content = content
+        response.from_cache = True
+        return response
+
+    def store(self, url, response):
+        """
+        缓存带有 ETag 或 Last-Modified 的 200 响应，其余响应无法重新验证，不缓存
+        """
+        headers = dict((name, response.headers[name]) for name in CACHED_HEADERS if name in response.headers)
+        if response.status_code != 200 or not ("ETag" in headers or "Last-Modified" in headers):
+            return
+        content = response.content
+        digest = hashlib.sha1(content).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        with self._lock:
+            self._entries[url] = {
+                "digest": digest,
+                "size": len(content),
+                "headers": headers,
+                "encoding": response.encoding,
+                "atime": time.time(),
+            }
+            self._dirty = True
+            self._evict()
+
+    def fetch(self, session, url, **kwargs):
+        """
+        带条件请求的 GET：服务器返回 304 时使用缓存的正文
+        :param session: 发送请求的会话对象（requests.Session 或 PooledSession）
+        :return: Response 对象，命中缓存时 response.from_cache 为 True
+        """
+        headers = dict(kwargs.pop("headers", None) or {})
+        conditional = dict(headers, **self.conditional_headers(url))
+        response = session.get(url, headers=conditional, **kwargs)
+        if response.status_code == 304:
+            cached = self.load(url)
+            if cached is not None:
+                with self._lock:
+                    self.hits += 1
+                return cached
+            # 缓存已经丢失，去掉条件头重新请求完整正文
+            response = session.get(url, headers=headers, **kwargs)
+        with self._lock:
+            if response.status_code >= 400:
+                self.errors += 1
+            else:
+                self.misses += 1
+        self.store(url, response)
+        response.from_cache = False
+        return response
+
+    def _evict(self):
+        # 同一份正文可能被多个 url 引用，按正文去重计算总大小，引用计数归零时才删除正文
+        sizes = {}
+        refs = {}
+        for entry in self._entries.values():
+            sizes[entry["digest"]] = entry["size"]
+            refs[entry["digest"]] = refs.get(entry["digest"], 0) + 1
+        total = sum(sizes.values())
+        if total <= self.max_bytes:
+            return
+        for url, entry in sorted(self._entries.items(), key=lambda item: item[1]["atime"]):
+            if total <= self.max_bytes:
+                break
+            del self._entries[url]
+            digest = entry["digest"]
+            refs[digest] -= 1
+            if refs[digest]:
+                continue
+            total -= entry["size"]
+            try:
+                os.remove(self._object_path(digest))
+            except OSError:
+                pass
+
+    def save(self):
+        """
+        把索引写回磁盘，先写临时文件再替换，避免中途退出损坏索引
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps(self._entries)
+            self._dirty = False
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, self.index_path)
+
+
+if __name__ == '__main__':
+    # 用本地 HTTP 服务模拟站点，验证第二次抓取时服务器返回 304，正文来自缓存
+    import shutil
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    import requests
+
+    pages = {"/a": b"<html>chapter a</html>", "/b": b"<html>chapter b</html>"}
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = pages[self.path]
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = "http://127.0.0.1:%d" % server.server_address[1]
+    cache_dir = tempfile.mkdtemp()
+    try:
+        session = requests.Session()
+        cache = HttpCache(cache_dir)
+        for path in pages:
+            cache.fetch(session, base + path)
+        cache.save()
+
+        pages["/b"] = b"<html>chapter b, revised</html>"
+        cache = HttpCache(cache_dir)
+        first = cache.fetch(session, base + "/a")
+        second = cache.fetch(session, base + "/b")
+        assert first.from_cache and first.content == b"<html>chapter a</html>"
+        assert not second.from_cache and second.content == pages["/b"]
+        print("hits=%d misses=%d" % (cache.hits, cache.misses))
+    finally:
+        server.shutdown()
+        shutil.rmtree(cache_dir)
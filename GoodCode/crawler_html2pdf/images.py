@@ -0,0 +1,156 @@
+# coding=utf-8
+"""
+图片预取：章节解析完成后立即并发下载其中的图片，按内容哈希去重保存到本地，
+渲染前把 html 中的图片地址改写成本地文件或 data URI，wkhtmltopdf 渲染时不再访问网络
+"""
+import base64
+import hashlib
+import io
+import json
+import logging
+import mimetypes
+import os
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+IMG_PATTERN = re.compile("(<img.*?src=\")(.*?)(\")")
+
+
+class ImageStore(object):
+    """
+    目录结构：
+        <directory>/index.json      图片 url -> 本地文件名
+        <directory>/<sha1>.<ext>    按内容哈希命名的图片，多个 url 指向同一张图片时只保存一份
+    """
+
+    def __init__(self, directory, fetch, workers=8, mode="data", max_width=None):
+        """
+        :param directory: 图片缓存目录，多次生成 PDF 时共用
+        :param fetch: 下载函数，接收 url，返回 response 对象
+        :param workers: 同时下载的图片数
+        :param mode: "data" 改写为 data URI，"file" 改写为本地 file:// 路径
+        :param max_width: 图片最大宽度（像素），超过时等比缩小，需要安装 Pillow
+        """
+        if mode not in ("data", "file"):
+            raise ValueError("mode must be 'data' or 'file', got %r" % mode)
+        self.directory = directory
+        self.fetch = fetch
+        self.mode = mode
+        self.max_width = max_width if Image is not None else None
+        if max_width and Image is None:
+            logging.warning(u"没有安装 Pillow，图片不会缩小")
+        self.index_path = os.path.join(directory, "index.json")
+        self._index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                self._index = json.load(f)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def _download(self, url):
+        """
+        :return: 本地文件名，下载失败时返回 None
+        """
+        try:
+            response = self.fetch(url)
+        except Exception:
+            logging.warning(u"图片下载失败：%s", url, exc_info=True)
+            return None
+        if getattr(response, "status_code", 200) != 200:
+            logging.warning(u"图片下载失败：%s 返回 %d", url, response.status_code)
+            return None
+        content = response.content
+        content_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+        ext = mimetypes.guess_extension(content_type) or os.path.splitext(url)[1] or ".img"
+        digest = hashlib.sha1(content).hexdigest()
+        if self.max_width:
+            digest = "%s-w%d" % (digest, self.max_width)
+            content = self._shrink(content)
+        filename = digest + ext
+        path = os.path.join(self.directory, filename)
+        if not os.path.exists(path):
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        with self._lock:
+            self._index[url] = filename
+        return filename
+
+    def _shrink(self, content):
+        try:
+            image = Image.open(io.BytesIO(content))
+            if image.width <= self.max_width:
+                return content
+            height = int(image.height * float(self.max_width) / image.width)
+            output = io.BytesIO()
+            image.resize((self.max_width, max(1, height))).save(output, format=image.format)
+            return output.getvalue()
+        except Exception:
+            logging.warning(u"图片缩小失败，使用原图", exc_info=True)
+            return content
+
+    def prefetch(self, html):
+        """
+        提交 html 中尚未下载过的图片，立即返回
+        :param html: utf-8 编码的 html
+        """
+        for match in IMG_PATTERN.finditer(html.decode("utf-8")):
+            url = match.group(2)
+            if not url.startswith("http"):
+                continue
+            with self._lock:
+                if url in self._futures or url in self._index:
+                    continue
+                self._futures[url] = self._executor.submit(self._download, url)
+
+    def _local_src(self, url):
+        with self._lock:
+            future = self._futures.get(url)
+        if future is not None:
+            future.result()
+        with self._lock:
+            filename = self._index.get(url)
+        if filename is None:
+            return url
+        path = os.path.abspath(os.path.join(self.directory, filename))
+        if not os.path.exists(path):
+            return url
+        if self.mode == "file":
+            return "file://" + path
+        with open(path, "rb") as f:
+            data = base64.b64encode(f.read()).decode("ascii")
+        mime = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        return "data:%s;base64,%s" % (mime, data)
+
+    def embed(self, html):
+        """
+        等待 html 中的图片下载完成，把图片地址改写为本地地址，下载失败的图片保留原地址
+        :return: 改写后的 utf-8 编码的 html
+        """
+        def func(m):
+            return "".join([m.group(1), self._local_src(m.group(2)), m.group(3)])
+
+        return IMG_PATTERN.sub(func, html.decode("utf-8")).encode("utf-8")
+
+    def close(self):
+        """
+        等待下载完成并保存索引
+        """
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            data = json.dumps(self._index)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.replace(tmp_path, self.index_path)
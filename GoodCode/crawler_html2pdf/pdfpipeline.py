@@ -0,0 +1,103 @@
+# coding=utf-8
+"""
+边抓取边渲染 PDF：每个章节解析完成后立即交给后台线程渲染成 PDF 片段，
+抓取下一章的同时上一章已经在渲染，全部完成后再按顺序合并成一个 PDF
+"""
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pdfkit
+
+try:
+    from pypdf import PdfWriter
+except ImportError:
+    try:
+        from PyPDF2 import PdfMerger as PdfWriter
+    except ImportError:
+        PdfWriter = None
+
+
+class PdfAssembler(object):
+    """
+    用法：
+        with PdfAssembler("book.pdf", options) as assembler:
+            for html in chapters:
+                assembler.add(html)
+            assembler.finish()
+
+    所有中间文件都放在私有的临时目录中，无论成功还是失败，退出 with 块时都会删除。
+    没有安装 pypdf/PyPDF2 时无法合并片段，退化为最后一次性渲染临时目录中的 html 文件。
+    """
+
+    def __init__(self, output, options=None, workers=2, transform=None):
+        """
+        :param output: 输出的 PDF 文件路径
+        :param options: 传给 wkhtmltopdf 的选项
+        :param workers: 同时运行的 wkhtmltopdf 进程数
+        :param transform: 渲染前对章节 html 做的处理，在渲染线程中执行，例如 ImageStore.embed
+        """
+        self.output = output
+        self.options = options
+        self.workers = workers
+        self.transform = transform
+        self.streaming = PdfWriter is not None
+        self.count = 0
+        self.scratch_dir = None
+        self._executor = None
+        self._fragments = []
+
+    def __enter__(self):
+        self.scratch_dir = tempfile.mkdtemp(prefix="html2pdf-")
+        if self.streaming:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._executor is not None:
+            if exc_type is not None:
+                for fragment in self._fragments:
+                    fragment.cancel()
+            self._executor.shutdown(wait=True)
+        shutil.rmtree(self.scratch_dir, ignore_errors=True)
+
+    def _path(self, suffix):
+        return os.path.join(self.scratch_dir, "%05d.%s" % (self.count, suffix))
+
+    def _render(self, html, path):
+        if self.transform is not None:
+            html = self.transform(html)
+        pdfkit.from_string(html.decode("utf-8"), path, options=self.options)
+        return path
+
+    def add(self, html):
+        """
+        加入下一个章节
+        :param html: parse_body 返回的 utf-8 编码的 html
+        """
+        if self.streaming:
+            future = self._executor.submit(self._render, html, self._path("pdf"))
+            self._fragments.append(future)
+        else:
+            path = self._path("html")
+            if self.transform is not None:
+                html = self.transform(html)
+            with open(path, "wb") as f:
+                f.write(html)
+            self._fragments.append(path)
+        self.count += 1
+
+    def finish(self):
+        """
+        等待所有片段渲染完成并合并成最终的 PDF 文件
+        """
+        if not self.streaming:
+            pdfkit.from_file(self._fragments, self.output, options=self.options)
+            return
+        writer = PdfWriter()
+        for fragment in self._fragments:
+            writer.append(fragment.result())
+        with open(self.output, "wb") as f:
+            writer.write(f)
+        writer.close()
@@ -15,27 +15,103 @@
 # under the License.
 
 
+import heapq
+import json
 import logging
+import socket
+import tempfile
 import tornado.escape
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
+import tornado.websocket
 import os.path
+import time
 import uuid
+from collections import OrderedDict, deque
 
 
 from tornado.concurrent import Future
 from tornado import gen
+from tornado.httpserver import HTTPServer
+from tornado.iostream import IOStream, StreamClosedError
 from tornado.options import define, options, parse_command_line
+from tornado.tcpserver import TCPServer
 
 define("port", default=8888, help="run on the given port", type=int)
 define("debug", default=False, help="run in debug mode")
+define("room_idle_timeout", default=600, help="seconds before an idle room's buffer is dropped", type=int)
+define("processes", default=1, help="number of worker processes sharing the port, 0 for one per CPU", type=int)
+define("bus_socket", default=None, help="Unix socket of the message bus in multi-process mode")
+define("coalesce_ms", default=0, help="collect posts for this many milliseconds before waking waiters", type=float)
+define("coalesce_max", default=100, help="wake waiters early once this many posts are collected", type=int)
+
+DEFAULT_ROOM = "lobby"
+
+
+class MessageBatch(list):
+    """
+    The messages handed to waiters. The JSON payload is encoded once on
+    first use and then shared by every client the batch is written to.
+    """
+
+    _payload = None
+
+    @property
+    def payload(self):
+        if self._payload is None:
+            self._payload = tornado.escape.json_encode(dict(message=self))
+        return self._payload
 
 
 class MessageBuffer(object):
-    def __init__(self):
-        self.writers = set()
-        self.cache = []
-        self.cache_size = 200
+    """
+    Keeps the last cache_size messages in a fixed-size ring buffer.
+
+    Every message gets a sequence number, and an id -> sequence dict turns a
+    client's cursor into a position in the ring in O(1), so appending and
+    resolving a cursor cost the same whether the buffer holds 200 messages
+    or 100k.
+
+    With coalesce_delay > 0, posts are collected for that many seconds (or
+    until coalesce_max messages) and waiters are woken once with the whole
+    batch instead of once per post.
+    """
+
+    def __init__(self, cache_size=200, coalesce_delay=0, coalesce_max=100):
+        self.waiters = {}   # future -> first sequence number the waiter still needs, None for any
+        self.cache_size = cache_size
+        self.coalesce_delay = coalesce_delay
+        self.coalesce_max = coalesce_max
+        self._pending = MessageBatch()
+        self._flush_handle = None
+        self._ring = [None] * cache_size
+        self._index = {}    # message id -> sequence number
+        self._next_seq = 0  # sequence number of the next message
+        self._visible = 0   # messages before this sequence number have been sent to waiters
+
+    def __len__(self):
+        return min(self._next_seq, self.cache_size)
+
+    @property
+    def cache(self):
+        """The buffered messages, oldest first."""
+        return self.messages_since(0)
+
+    def messages_since(self, seq):
+        """Messages with sequence number >= seq that are still buffered and already sent to waiters."""
+        seq = max(seq, self._next_seq - len(self))
+        return [self._ring[i % self.cache_size] for i in range(seq, self._visible)]
+
+    def append(self, message):
+        slot = self._next_seq % self.cache_size
+        evicted = self._ring[slot]
+        if evicted is not None:
+            del self._index[evicted["id"]]
+        self._ring[slot] = message
+        self._index[message["id"]] = self._next_seq
+        self._next_seq += 1
 
     def wait_for_message(self, cursor=None):
         # Constructor a Future to return to our caller. This allows
@@ -43,43 +119,289 @@ class MessageBuffer(object):
         # it is not a coroutine itself. We will set the result of the
         # Future when result are available
         result_future = Future()
+        start = None
         if cursor:
-            new_count = 0
-            for msg in reversed(self.cache):
-                if msg["id"] == cursor:
-                    break
-                new_count += 1
-            if new_count:
-                result_future.set_result(self.cache[-new_count:])
+            seq = self._index.get(cursor)
+            # an unknown cursor has fallen out of the buffer: send everything we still have
+            new_messages = self.messages_since(seq + 1 if seq is not None else 0)
+            if new_messages:
+                result_future.set_result(MessageBatch(new_messages))
                 return result_future
-        self.waiters.add(result_future)
+            if seq is not None and seq >= self._visible:
+                # the cursor points into a batch that is still being collected
+                start = seq + 1
+        self.waiters[result_future] = start
         return result_future
 
     def cancel_wait(self, future):
-        self.waiters.remove(future)
+        self.waiters.pop(future, None)
         # Set an empty result to unblock any coroutines waiting
-        future.set_result([])
+        if not future.done():
+            future.set_result(MessageBatch())
 
     def new_messages(self, message):
-        logging.info("Sending new message to %r listeners", len(self.waiters))
-        for future in self.waiters:
-            future.set_result(message)
-        self.waiters = set()
-        self.cache.extend(message)
-        if len(self.cache) > self.cache_size:
-            self.cache = self.cache[-self.cache_size:]
+        # messages are buffered right away so that cursor lookups see them,
+        # only waking the waiters is deferred while coalescing
+        for msg in message:
+            self.append(msg)
+        self._pending.extend(message)
+        if not self.coalesce_delay or len(self._pending) >= self.coalesce_max:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = tornado.ioloop.IOLoop.current().call_later(self.coalesce_delay, self.flush)
+
+    def flush(self):
+        if self._flush_handle is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self._flush_handle)
+            self._flush_handle = None
+        batch, self._pending = self._pending, MessageBatch()
+        if not batch:
+            return
+        batch_start, self._visible = self._visible, self._next_seq
+        logging.debug("Sending %d new messages to %r listeners", len(batch), len(self.waiters))
+        waiters, self.waiters = self.waiters, {}
+        for future, start in waiters.items():
+            if start is None or start <= batch_start:
+                future.set_result(batch)
+            elif start < self._visible:
+                future.set_result(MessageBatch(batch[start - batch_start:]))
+            else:
+                self.waiters[future] = start
+
+
+class RoomRegistry(object):
+    """
+    One MessageBuffer per room, created on first use.
+
+    Rooms are kept in least-recently-used order, so evicting idle rooms only
+    touches the rooms that are actually dropped. A room with waiting clients
+    is never evicted.
+    """
+
+    def __init__(self, cache_size=200, idle_timeout=600, coalesce_delay=0, coalesce_max=100):
+        self.cache_size = cache_size
+        self.idle_timeout = idle_timeout
+        self.coalesce_delay = coalesce_delay
+        self.coalesce_max = coalesce_max
+        self.rooms = OrderedDict()  # room -> (MessageBuffer, last used)
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def get(self, room):
+        entry = self.rooms.pop(room, None)
+        if entry is not None:
+            buffer = entry[0]
+        else:
+            buffer = MessageBuffer(self.cache_size, self.coalesce_delay, self.coalesce_max)
+        self.rooms[room] = (buffer, time.monotonic())
+        return buffer
+
+    def evict_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        busy = []
+        while self.rooms:
+            room, (buffer, last_used) = next(iter(self.rooms.items()))
+            if last_used > deadline:
+                break
+            del self.rooms[room]
+            if buffer.waiters:
+                busy.append((room, buffer))
+        # rooms with open long-polls stay, as if they had just been used
+        for room, buffer in busy:
+            self.rooms[room] = (buffer, time.monotonic())
+        return len(busy)
+
+
+class LocalBus(object):
+    """Single-process mode: a posted message goes straight into the room's buffer."""
+
+    def __init__(self, rooms):
+        self.rooms = rooms
+
+    def publish(self, room, messages):
+        self.rooms.get(room).new_messages(messages)
+
+
+class MessageBusHub(TCPServer):
+    """
+    Runs in its own process in multi-process mode. Every worker sends the
+    messages posted to it; the hub stamps each batch with the next sequence
+    number and sends it to all workers, the sender included, so every worker
+    applies the same stream in the same order.
+
+    The last history_size batches of every room are kept, so a worker that
+    (re)connects or notices a gap in the sequence numbers can have what it
+    missed replayed. A replay is framed by {"epoch", "replay": since} and
+    {"replayed": seq} lines. The epoch changes whenever the hub restarts,
+    because its sequence numbers start over.
+    """
+
+    def __init__(self, history_size=200, idle_timeout=600):
+        super(MessageBusHub, self).__init__()
+        self.epoch = uuid.uuid4().hex
+        self.seq = 0
+        self.history_size = history_size
+        self.idle_timeout = idle_timeout
+        self.history = OrderedDict()    # room -> (deque of (seq, line), last used)
+        self.streams = set()
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        try:
+            # a worker starts with the epoch and sequence number it has applied up to
+            hello = json.loads((yield stream.read_until(b"\n")))
+            self.replay(stream, hello["seq"] if hello.get("epoch") == self.epoch else 0)
+            self.streams.add(stream)
+            while True:
+                event = json.loads((yield stream.read_until(b"\n")))
+                if "replay" in event:
+                    self.replay(stream, event["replay"])
+                else:
+                    self.broadcast(event)
+        except StreamClosedError:
+            pass
+        finally:
+            self.streams.discard(stream)
+
+    def broadcast(self, event):
+        self.seq += 1
+        event["seq"] = self.seq
+        data = json.dumps(event).encode("utf-8") + b"\n"
+        entry = self.history.pop(event["room"], None)
+        recent = entry[0] if entry is not None else deque(maxlen=self.history_size)
+        recent.append((self.seq, data))
+        self.history[event["room"]] = (recent, time.monotonic())
+        for worker in list(self.streams):
+            try:
+                worker.write(data)
+            except StreamClosedError:
+                self.streams.discard(worker)
+
+    def replay(self, stream, since):
+        """Send the kept batches after sequence number since, oldest first, across all rooms."""
+        stream.write(json.dumps(dict(epoch=self.epoch, replay=since)).encode("utf-8") + b"\n")
+        for seq, data in heapq.merge(*[recent for recent, _ in self.history.values()]):
+            if seq > since:
+                stream.write(data)
+        stream.write(json.dumps(dict(replayed=self.seq)).encode("utf-8") + b"\n")
+
+    def evict_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        while self.history:
+            room, (recent, last_used) = next(iter(self.history.items()))
+            if last_used > deadline:
+                break
+            del self.history[room]
+
+
+def run_bus_hub(hub_socket):
+    hub = MessageBusHub(global_rooms.cache_size, options.room_idle_timeout)
+    hub.add_socket(hub_socket)
+    tornado.ioloop.PeriodicCallback(hub.evict_idle, 60 * 1000).start()
+    tornado.ioloop.IOLoop.current().start()
+
+
+class MessageBus(object):
+    """
+    Worker side of the message bus: publishes to the hub and applies what it
+    broadcasts.
 
+    When the hub goes away the worker keeps serving and reconnects with
+    exponential backoff. Posts made meanwhile are held back and sent once it
+    is back, and the hub replays the batches this worker missed.
+    """
 
-global_message_buffer = MessageBuffer()
+    def __init__(self, rooms, path, min_delay=0.1, max_delay=5.0):
+        self.rooms = rooms
+        self.path = path
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.epoch = None
+        self.seq = 0
+        self.stream = None
+        self.outbox = deque()
+        self._replaying = False     # inside a replay, sequence numbers may skip batches the hub no longer has
+        self._requested = False     # a replay was asked for and has not started yet
 
+    def start(self):
+        tornado.ioloop.IOLoop.current().spawn_callback(self._run)
 
-class MainHandler(tornado.web.RedirectHandler):
-    def get(self):
-        self.render("index.html", messages=global_message_buffer.cache)
+    def publish(self, room, messages):
+        data = json.dumps(dict(room=room, messages=messages)).encode("utf-8") + b"\n"
+        if self.stream is None:
+            self.outbox.append(data)
+            return
+        try:
+            self.stream.write(data)
+        except StreamClosedError:
+            self.outbox.append(data)
+
+    @gen.coroutine
+    def _run(self):
+        delay = self.min_delay
+        while True:
+            stream = IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+            try:
+                yield stream.connect(self.path)
+            except (StreamClosedError, socket.error) as e:
+                stream.close()
+                logging.warning("Cannot reach the message bus (%s), retrying in %.1fs", e, delay)
+                yield gen.sleep(delay)
+                delay = min(delay * 2, self.max_delay)
+                continue
+            delay = self.min_delay
+            self.stream = stream
+            try:
+                stream.write(json.dumps(dict(epoch=self.epoch, seq=self.seq)).encode("utf-8") + b"\n")
+                while self.outbox:
+                    stream.write(self.outbox[0])
+                    self.outbox.popleft()
+                yield self._receive(stream)
+            except StreamClosedError:
+                logging.error("Lost connection to the message bus, reconnecting")
+            self.stream = None
+            self._replaying = self._requested = False
+
+    @gen.coroutine
+    def _receive(self, stream):
+        while True:
+            event = json.loads((yield stream.read_until(b"\n")))
+            if "replay" in event:
+                if event["epoch"] != self.epoch:
+                    if self.epoch is not None:
+                        logging.warning("Message bus restarted, batches it had not sent yet are lost")
+                    self.epoch = event["epoch"]
+                self.seq = event["replay"]
+                self._replaying, self._requested = True, False
+            elif "replayed" in event:
+                self._replaying = False
+                self.seq = max(self.seq, event["replayed"])
+            elif event["seq"] <= self.seq:
+                continue
+            elif event["seq"] == self.seq + 1 or self._replaying:
+                if event["seq"] != self.seq + 1 and self.seq:
+                    logging.warning("Message bus no longer has batches %d to %d", self.seq + 1, event["seq"] - 1)
+                self.seq = event["seq"]
+                self.rooms.get(event["room"]).new_messages(event["messages"])
+            elif not self._requested:
+                # drop everything up to the replay, which resends it in order
+                logging.warning("Message bus skipped from %d to %d, asking for a replay", self.seq, event["seq"])
+                self._requested = True
+                stream.write(json.dumps(dict(replay=self.seq)).encode("utf-8") + b"\n")
+
+
+global_rooms = RoomRegistry()
+global_bus = LocalBus(global_rooms)
+
+
+class MainHandler(tornado.web.RequestHandler):
+    def get(self, room=DEFAULT_ROOM):
+        self.render("index.html", messages=global_rooms.get(room).cache, room=room)
 
 
 class MessageNewHandler(tornado.web.RequestHandler):
-    def post(self):
+    def post(self, room=DEFAULT_ROOM):
         message = {
             "id": str(uuid.uuid4()),
             "body": self.get_argument("body")
@@ -91,42 +413,152 @@ class MessageNewHandler(tornado.web.RequestHandler):
             self.redirect(self.get_argument("next"))
         else:
             self.write(message)
-        global_message_buffer.new_messages([message])
+        global_bus.publish(room, [message])
 
 
 class MessageUpdateHandler(tornado.web.RequestHandler):
     @gen.coroutine
-    def post(self):
+    def post(self, room=DEFAULT_ROOM):
         cursor = self.get_argument("cursor", None)
-        # Save the future returned by wait_for_messages so we can cancel
-        # it in wait_for_message
-        self.future = global_message_buffer.wait_for_message(cursor=cursor)
+        # Save the buffer and the future returned by wait_for_messages so
+        # we can cancel it in on_connection_close
+        self.buffer = global_rooms.get(room)
+        self.future = self.buffer.wait_for_message(cursor=cursor)
         message = yield self.future
         if self.request.connection.stream.closed():
             return
-        self.write(dict(message=message))
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
+        self.write(message.payload)
 
     def on_connection_close(self):
-        global_message_buffer.cancel_wait(self.future)
+        if getattr(self, "future", None) is not None:
+            self.buffer.cancel_wait(self.future)
 
 
-def main():
-    parse_command_line()
-    app = tornado.web.Application(
-        [
-            (r"/", MainHandler),
-            (r"/a/message/new", MessageNewHandler),
-            (r"/a/message/updates", MessageUpdatesHandler)
-        ],
+class MessageSocketHandler(tornado.websocket.WebSocketHandler):
+    """
+    Pushes every batch over one WebSocket instead of ending a long-poll
+    request per batch; the cursor lives on the server between batches.
+    """
+
+    def open(self, room=DEFAULT_ROOM):
+        self.buffer = global_rooms.get(room)
+        self.future = None
+        tornado.ioloop.IOLoop.current().spawn_callback(self.send_updates, self.get_argument("cursor", None))
+
+    @gen.coroutine
+    def send_updates(self, cursor):
+        while self.ws_connection is not None:
+            self.future = self.buffer.wait_for_message(cursor=cursor)
+            message = yield self.future
+            if not message or self.ws_connection is None:
+                return
+            cursor = message[-1]["id"]
+            try:
+                yield self.write_message(message.payload)
+            except tornado.websocket.WebSocketClosedError:
+                return
+
+    def on_message(self, message):
+        pass
+
+    def on_close(self):
+        if self.future is not None:
+            self.buffer.cancel_wait(self.future)
+
+
+class MessageStreamHandler(tornado.web.RequestHandler):
+    """
+    Server-Sent Events: one long-lived GET, each batch is an event whose id
+    is the last message id, so EventSource resumes via Last-Event-ID.
+    """
+
+    @gen.coroutine
+    def get(self, room=DEFAULT_ROOM):
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        cursor = self.request.headers.get("Last-Event-ID") or self.get_argument("cursor", None)
+        self.buffer = global_rooms.get(room)
+        self.closed = False
+        yield self.flush()
+        while not self.closed:
+            self.future = self.buffer.wait_for_message(cursor=cursor)
+            message = yield self.future
+            if not message or self.closed:
+                return
+            cursor = message[-1]["id"]
+            self.write("id: %s\ndata: %s\n\n" % (cursor, message.payload))
+            try:
+                yield self.flush()
+            except StreamClosedError:
+                return
+
+    def on_connection_close(self):
+        self.closed = True
+        if getattr(self, "future", None) is not None:
+            self.buffer.cancel_wait(self.future)
+
+
+def make_app(**settings):
+    app_settings = dict(
         cookie_secret="__TODO:_GENERATE_YOUR_OWN_RANDOM_VALUW_HERE__",
         template_path=os.path.join(os.path.dirname(__file__), "templates"),
         static_path=os.path.join(os.path.dirname(__file__), "static"),
         xsrf_cookies=True,
         debug=options.debug
     )
-    app.listen(options.port)
-    tornado.ioloop.IOLoop.current().start()
+    app_settings.update(settings)
+    return tornado.web.Application(
+        [
+            (r"/", MainHandler),
+            (r"/a/message/new", MessageNewHandler),
+            (r"/a/message/updates", MessageUpdateHandler),
+            (r"/a/message/socket", MessageSocketHandler),
+            (r"/a/message/stream", MessageStreamHandler),
+            (r"/room/([\w-]+)", MainHandler),
+            (r"/room/([\w-]+)/a/message/new", MessageNewHandler),
+            (r"/room/([\w-]+)/a/message/updates", MessageUpdateHandler),
+            (r"/room/([\w-]+)/a/message/socket", MessageSocketHandler),
+            (r"/room/([\w-]+)/a/message/stream", MessageStreamHandler)
+        ],
+        **app_settings
+    )
+
 
+def main():
+    global global_bus
+    parse_command_line()
+    global_rooms.idle_timeout = options.room_idle_timeout
+    global_rooms.coalesce_delay = options.coalesce_ms / 1000.0
+    global_rooms.coalesce_max = options.coalesce_max
+    if options.processes == 1:
+        app = make_app()
+        app.listen(options.port)
+        tornado.ioloop.PeriodicCallback(global_rooms.evict_idle, 60 * 1000).start()
+        tornado.ioloop.IOLoop.current().start()
+        return
+
+    # multi-process mode: one child more than the workers runs the bus hub.
+    # fork_processes restarts any child that dies, the hub included, and the
+    # parent keeps the sockets bound so restarted children can pick them up
+    path = options.bus_socket or os.path.join(tempfile.gettempdir(), "chatdemo-%d.sock" % options.port)
+    hub_socket = tornado.netutil.bind_unix_socket(path)
+    sockets = tornado.netutil.bind_sockets(options.port)
+    workers = options.processes if options.processes > 0 else tornado.process.cpu_count()
+    task_id = tornado.process.fork_processes(workers + 1)
+    if task_id == workers:
+        for sock in sockets:
+            sock.close()
+        run_bus_hub(hub_socket)
+        return
+    hub_socket.close()
+
+    global_bus = MessageBus(global_rooms, path)
+    server = HTTPServer(make_app())
+    server.add_sockets(sockets)
+    global_bus.start()
+    tornado.ioloop.PeriodicCallback(global_rooms.evict_idle, 60 * 1000).start()
+    tornado.ioloop.IOLoop.current().start()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""
+Load test for the chat demo's three delivery paths: long-polling
+(/a/message/updates), WebSocket (/a/message/socket) and Server-Sent Events
+(/a/message/stream).
+
+Starts chatdemo in a child process, connects --clients subscribers per
+transport to the same room, posts --messages messages at --rate per second
+and reports delivery latency and how many HTTP requests the subscribers
+needed per delivered message.
+
+    python loadtest.py --clients=200 --messages=500 --rate=200
+    python loadtest.py --clients=200 --messages=500 --rate=200 --coalesce_ms=20
+"""
+import json
+import multiprocessing
+import time
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.options import define, options, parse_command_line
+from tornado.websocket import websocket_connect
+
+import chatdemo
+
+# --port is chatdemo's option: the port the chat server under test listens on
+define("clients", default=100, help="subscribers per transport", type=int)
+define("messages", default=200, help="messages to post", type=int)
+define("rate", default=100.0, help="messages posted per second", type=float)
+define("transports", default="poll,ws,sse", help="comma separated: poll, ws, sse")
+
+
+def run_server(port):
+    # the child inherits the parsed options, so --coalesce_ms / --coalesce_max apply here too
+    chatdemo.global_rooms.coalesce_delay = options.coalesce_ms / 1000.0
+    chatdemo.global_rooms.coalesce_max = options.coalesce_max
+    chatdemo.make_app(xsrf_cookies=False).listen(port)
+    IOLoop.current().start()
+
+
+class Stats(object):
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.requests = 0
+
+    def received(self, messages):
+        now = time.time()
+        for message in messages:
+            self.latencies.append(now - float(message["body"]))
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            print("%-5s no messages delivered" % self.name)
+            return
+        pick = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+        print("%-5s delivered %7d  p50 %7.2f ms  p99 %7.2f ms  max %7.2f ms  requests %6d  requests/message %.3f" % (
+            self.name, len(latencies), pick(0.5), pick(0.99), latencies[-1] * 1000,
+            self.requests, float(self.requests) / len(latencies)))
+
+
+@gen.coroutine
+def poll_client(base, stats, done):
+    client = AsyncHTTPClient()
+    cursor = None
+    while not done():
+        body = "cursor=%s" % cursor if cursor else ""
+        stats.requests += 1
+        response = yield client.fetch(base + "/a/message/updates", method="POST", body=body,
+                                      request_timeout=3600, raise_error=False)
+        if response.code != 200:
+            return
+        messages = json.loads(response.body)["message"]
+        stats.received(messages)
+        if messages:
+            cursor = messages[-1]["id"]
+
+
+@gen.coroutine
+def ws_client(base, stats, done):
+    stats.requests += 1
+    connection = yield websocket_connect(base.replace("http", "ws", 1) + "/a/message/socket")
+    while not done():
+        data = yield connection.read_message()
+        if data is None:
+            return
+        stats.received(json.loads(data)["message"])
+    connection.close()
+
+
+@gen.coroutine
+def sse_client(base, stats, done):
+    buffered = [b""]
+
+    def on_chunk(chunk):
+        buffered[0] += chunk
+        while b"\n\n" in buffered[0]:
+            event, buffered[0] = buffered[0].split(b"\n\n", 1)
+            for line in event.split(b"\n"):
+                if line.startswith(b"data: "):
+                    stats.received(json.loads(line[6:])["message"])
+
+    stats.requests += 1
+    request = HTTPRequest(base + "/a/message/stream", streaming_callback=on_chunk, request_timeout=3600)
+    try:
+        yield AsyncHTTPClient().fetch(request, raise_error=False)
+    except Exception:
+        pass
+
+
+CLIENTS = {"poll": poll_client, "ws": ws_client, "sse": sse_client}
+
+
+@gen.coroutine
+def run_transport(name, base):
+    stats = Stats(name)
+    expected = options.clients * options.messages
+    done = lambda: len(stats.latencies) >= expected
+    for _ in range(options.clients):
+        IOLoop.current().spawn_callback(CLIENTS[name], base, stats, done)
+    yield gen.sleep(1.0)    # let every subscriber connect
+
+    # posts are not awaited one by one, so the publishing rate does not
+    # depend on how quickly the subscribers keep up
+    publisher = AsyncHTTPClient(force_instance=True, max_clients=100)
+    interval = 1.0 / options.rate
+    start = time.time()
+    posts = []
+    for n in range(options.messages):
+        delay = start + n * interval - time.time()
+        if delay > 0:
+            yield gen.sleep(delay)
+        posts.append(publisher.fetch(base + "/a/message/new", method="POST", body="body=%r" % time.time()))
+    yield posts
+
+    deadline = time.time() + 10
+    while not done() and time.time() < deadline:
+        yield gen.sleep(0.1)
+    stats.report()
+
+
+@gen.coroutine
+def run(base):
+    for index, name in enumerate(options.transports.split(",")):
+        # a fresh room per transport, so each run starts with an empty buffer
+        yield run_transport(name, "%s/room/load%d" % (base, index))
+
+
+def main():
+    parse_command_line()
+    AsyncHTTPClient.configure(None, max_clients=options.clients * 2 + 10)
+    server = multiprocessing.Process(target=run_server, args=(options.port,))
+    server.daemon = True
+    server.start()
+    try:
+        time.sleep(1.0)
+        IOLoop.current().run_sync(lambda: run("http://127.0.0.1:%d" % options.port))
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
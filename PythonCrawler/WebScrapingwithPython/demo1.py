@@ -10,7 +10,9 @@
 # import whois
 # print(whois.whois('appspot.com'))
 
-import urllib
+
+from sitemap_crawler import SitemapCrawler, fetch
+
 # def download(url):
 #     return urllib.urlopen(url).read()
 # def download(url, num_retries=2):
@@ -26,27 +28,14 @@ import urllib
 #                 return download(url, num_retries-1)
 #     return html
 def download(url, user_agent='wrap', num_retries=2):
-    print('Downloading:', url)
-    headers = {'User-agent': user_agent}
-    request = urllib.Request(url, headers=headers)
-    try:
-        html = urllib.urlopen(request).read()
-    except urllib.URLError as e:
-        print('Download error:', e.reason)
-        html = None
-        if num_retries > 0:
-            if hasattr(e, 'code') and 500 <= e.code < 600:
-                # retry 5xx HTTP errors
-                return download(url, user_agent, num_retries-1)
-    return html
+    # shared keep-alive session, 5xx errors retried with exponential backoff,
+    # every request logged at DEBUG and counted in crawler_common.metrics
+    response = fetch(url, user_agent, num_retries)
+    return response.text if response is not None else None
 
-def crawl_sitemap(url):
-    # download the sitemap file
-    sitemap = download(url)
-    # download the sitemap links
-    links = re.findall('<loc>(.*?)</loc>', sitemap)
-    # download each link
-    for link in links
-        html = download(link)
+def crawl_sitemap(url, workers=8):
+    # stream the sitemap (and any nested or gzipped sitemaps) and download the links concurrently
+    for link, html in SitemapCrawler(workers=workers).crawl(url):
         # scrape html here
-        # ...
\ No newline at end of file
+        # ...
+        pass
@@ -0,0 +1,343 @@
+"""
+Sitemap crawler grown out of demo1.crawl_sitemap:
+
+* sitemaps are streamed and parsed incrementally, so huge sitemaps never sit in memory
+* sitemap indexes are followed, gzipped sitemaps (.xml.gz) are decompressed on the fly
+* page links are downloaded by a pool of worker threads
+* failed downloads are retried iteratively with exponential backoff
+* sitemaps are read on their own thread into a frontier that deduplicates normalized links
+  with a Bloom filter and spills the pending queue to disk, so memory stays flat on sitemaps
+  with millions of URLs even when parsing runs ahead of the downloads
+* every request is recorded in crawler_common.metrics (latency, bytes, status codes),
+  optionally as a JSON-lines trace and a Prometheus text file
+
+Run `python sitemap_crawler.py --demo` to crawl a small local test site, and
+`python sitemap_crawler.py --demo --sitemap-delay 2` to check that the pages of the
+first sitemap are downloaded while the second one is still loading.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from xml.etree.ElementTree import XMLPullParser
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'GoodCode'))
+from crawler_common.frontier import Frontier  # noqa: E402
+from crawler_common.metrics import Metrics, get_metrics  # noqa: E402
+from crawler_common.ratelimit import get_scheduler  # noqa: E402
+from crawler_common.session import get_session  # noqa: E402
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def fetch(url, user_agent='wrap', num_retries=2, backoff=1.0, stream=False, scheduler=None, metrics=None):
+    """
+    Download url, retrying network errors and 5xx responses with exponential backoff.
+    Requests wait for the per-domain budget of scheduler (the shared PolitenessScheduler by default)
+    and are recorded in metrics (the shared Metrics by default).
+    Returns the response, or None if the download failed.
+    """
+    headers = {'User-agent': user_agent}
+    session = get_session()
+    scheduler = scheduler or get_scheduler(session=session)
+    metrics = metrics or get_metrics()
+    for attempt in range(num_retries + 1):
+        logging.debug('Downloading: %s', url)
+        start = time.time()
+        try:
+            with scheduler.hold(url):
+                start = time.time()
+                response = session.get(url, headers=headers, stream=stream)
+        except requests.RequestException as e:
+            metrics.record_fetch(url, None, time.time() - start, error=e)
+            logging.warning('Download error: %s', e)
+        else:
+            # streamed bodies have not been read yet, fall back to Content-Length
+            size = int(response.headers.get('Content-Length') or 0) if stream else len(response.content)
+            metrics.record_fetch(url, response.status_code, time.time() - start, size)
+            if response.status_code < 400:
+                return response
+            logging.warning('Download error: %s %s %s', url, response.status_code, response.reason)
+            # an unread streamed body would keep the pooled connection checked out
+            response.close()
+            if not 500 <= response.status_code < 600:
+                # 4xx errors will not go away by retrying
+                return None
+        if attempt < num_retries:
+            time.sleep(backoff * 2 ** attempt)
+    return None
+
+
+def parse_sitemap(chunks):
+    """
+    Incrementally parse a sitemap or sitemap index fed as byte chunks,
+    transparently gunzipping it if needed.
+    Yields ('sitemap', loc) for sitemap index entries and ('url', loc) for pages.
+    """
+    parser = XMLPullParser(events=('end',))
+    decompressor = None
+    first = True
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if first:
+            first = False
+            if chunk[:2] == GZIP_MAGIC:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        parser.feed(chunk)
+        for entry in _read_entries(parser):
+            yield entry
+    if decompressor is not None:
+        parser.feed(decompressor.flush())
+    parser.close()
+    for entry in _read_entries(parser):
+        yield entry
+
+
+def _read_entries(parser):
+    for _, element in parser.read_events():
+        tag = element.tag.rsplit('}', 1)[-1]
+        if tag in ('url', 'sitemap'):
+            for child in element:
+                if child.tag.rsplit('}', 1)[-1] == 'loc' and child.text:
+                    yield ('sitemap' if tag == 'sitemap' else 'url'), child.text.strip()
+            # drop the finished entry so the tree does not grow with the sitemap
+            element.clear()
+
+
+class SitemapCrawler(object):
+
+    def __init__(self, workers=8, user_agent='wrap', num_retries=2, backoff=1.0, chunk_size=64 * 1024,
+                 scheduler=None, capacity=10000000, metrics=None):
+        """
+        capacity is the expected number of distinct links; it sizes the frontier's Bloom filter.
+        """
+        self.workers = workers
+        self.metrics = metrics or get_metrics()
+        self.capacity = capacity
+        self.scheduler = scheduler or get_scheduler(session=get_session())
+        self.user_agent = user_agent
+        self.num_retries = num_retries
+        self.backoff = backoff
+        self.chunk_size = chunk_size
+
+    def download(self, url):
+        response = fetch(url, self.user_agent, self.num_retries, self.backoff, scheduler=self.scheduler,
+                         metrics=self.metrics)
+        return response.text if response is not None else None
+
+    def links(self, sitemap_url):
+        """
+        Yield every page link reachable from sitemap_url, following sitemap indexes.
+        """
+        seen = set()
+        pending = deque([sitemap_url])
+        while pending:
+            # sitemaps are read in the order they are listed
+            url = pending.popleft()
+            if url in seen:
+                continue
+            seen.add(url)
+            self.metrics.inc('sitemaps')
+            response = fetch(url, self.user_agent, self.num_retries, self.backoff, stream=True,
+                             scheduler=self.scheduler, metrics=self.metrics)
+            if response is None:
+                continue
+            try:
+                # raw stream: gzipped sitemap files are decompressed by parse_sitemap,
+                # gzip Content-Encoding is undone by urllib3
+                chunks = response.raw.stream(self.chunk_size, decode_content=True)
+                for kind, loc in parse_sitemap(chunks):
+                    if kind == 'sitemap':
+                        pending.append(loc)
+                    else:
+                        self.metrics.inc('links')
+                        yield loc
+            finally:
+                response.close()
+
+    def crawl(self, sitemap_url):
+        """
+        Download every page in the sitemap on a pool of worker threads.
+        A reader thread adds the sitemap links to the frontier while the downloads pop from it,
+        so a sitemap that parses faster than its pages download queues up in the frontier.
+        Links from different domains are interleaved so one slow host does not hold up the others.
+        Yields (url, html) as downloads complete; html is None for failed downloads.
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor, Frontier(self.capacity) as frontier:
+            ready = threading.Condition()
+            stop = threading.Event()
+            finished = []   # the reader appends the exception it died with, or None
+
+            def read_sitemaps():
+                error = None
+                try:
+                    for link in self.links(sitemap_url):
+                        if stop.is_set():
+                            break
+                        try:
+                            with ready:
+                                if frontier.add(link):
+                                    ready.notify()
+                        except ValueError as e:
+                            # one malformed <loc> must not stop the crawl
+                            self.metrics.inc('bad_links')
+                            logging.warning('Skipping invalid link %r: %s', link, e)
+                except Exception as e:
+                    error = e
+                finally:
+                    with ready:
+                        finished.append(error)
+                        ready.notify()
+
+            def queued():
+                # an empty frontier first yields None so interleave hands out what it has buffered,
+                # only the next pull blocks until the reader adds a link
+                hinted = False
+                while True:
+                    with ready:
+                        if not frontier and not finished and not hinted:
+                            link = None
+                        else:
+                            while not frontier and not finished:
+                                ready.wait()
+                            if frontier:
+                                link = frontier.pop()
+                            elif finished[0] is not None:
+                                raise finished[0]
+                            else:
+                                return
+                    hinted = link is None
+                    yield link
+
+            reader = threading.Thread(target=read_sitemaps, name='sitemap-reader')
+            reader.daemon = True
+            reader.start()
+            try:
+                futures = {}
+                for link in self.scheduler.interleave(queued()):
+                    futures[executor.submit(self.download, link)] = link
+                    # keep a bounded number of downloads in flight
+                    if len(futures) >= self.workers * 2:
+                        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            yield futures.pop(future), future.result()
+                for future in list(futures):
+                    yield futures.pop(future), future.result()
+            finally:
+                # the frontier is closed on the way out, so the reader must be gone first
+                stop.set()
+                reader.join()
+
+
+def serve_demo_site(error_every=5, sitemap_delay=0.0):
+    """
+    Start a local test site with a sitemap index, a plain and a gzipped sitemap,
+    and pages that fail with 503 on their first request every `error_every` pages.
+    The gzipped sitemap is answered after sitemap_delay seconds.
+    Returns (server, base_url).
+    """
+    import gzip
+    import threading
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+    failed_once = set()
+
+    def urlset(base, pages):
+        items = ''.join('<url><loc>%s/page/%d</loc></url>' % (base, n) for n in pages)
+        return ('<?xml version="1.0" encoding="UTF-8"?>'
+                '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">%s</urlset>' % items).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            base = 'http://%s:%d' % self.server.server_address
+            content_type = 'application/xml'
+            if self.path == '/sitemap.xml':
+                body = ('<?xml version="1.0" encoding="UTF-8"?>'
+                        '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+                        '<sitemap><loc>%s/sitemap-1.xml</loc></sitemap>'
+                        '<sitemap><loc>%s/sitemap-2.xml.gz</loc></sitemap>'
+                        '</sitemapindex>' % (base, base)).encode()
+            elif self.path == '/sitemap-1.xml':
+                body = urlset(base, range(0, 20))
+            elif self.path == '/sitemap-2.xml.gz':
+                time.sleep(sitemap_delay)
+                body = gzip.compress(urlset(base, range(20, 40)))
+                content_type = 'application/x-gzip'
+            elif self.path.startswith('/page/'):
+                n = int(self.path.rsplit('/', 1)[1])
+                if n % error_every == 0 and n not in failed_once:
+                    failed_once.add(n)
+                    self.send_response(503)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = ('<html><body>page %d</body></html>' % n).encode()
+                content_type = 'text/html'
+            else:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = type('ThreadingHTTPServer', (ThreadingMixIn, HTTPServer), {'daemon_threads': True})(
+        ('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Crawl every page listed in a sitemap')
+    parser.add_argument('sitemap', nargs='?', help='sitemap or sitemap index URL')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--demo', action='store_true', help='crawl a local test site')
+    parser.add_argument('--sitemap-delay', type=float, default=0.0,
+                        help='with --demo, seconds the second sitemap takes to load')
+    parser.add_argument('--trace', help='write a JSON-lines trace of every request to this file')
+    parser.add_argument('--prometheus', help='write Prometheus text metrics to this file when done')
+    parser.add_argument('-v', '--verbose', action='store_true', help='log every download')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    if args.demo:
+        server, base = serve_demo_site(sitemap_delay=args.sitemap_delay)
+        args.sitemap = base + '/sitemap.xml'
+    elif not args.sitemap:
+        parser.error('a sitemap URL or --demo is required')
+    metrics = Metrics('sitemap', trace_path=args.trace, prometheus_path=args.prometheus)
+    crawler = SitemapCrawler(workers=args.workers, backoff=0.1 if args.demo else 1.0, metrics=metrics)
+    start = time.time()
+    first = None
+    results = []
+    try:
+        for result in crawler.crawl(args.sitemap):
+            if first is None:
+                first = time.time() - start
+            results.append(result)
+    finally:
+        metrics.close()
+    print('Crawled %d pages in %.2fs (first after %.2fs), %d failed' % (
+        len(results), time.time() - start, first or 0.0, sum(1 for _, html in results if html is None)))
+    print(metrics.summary())